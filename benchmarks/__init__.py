@@ -0,0 +1,3 @@
+# Benchmarks of the lucid detection functions on synthetic images
+#
+#   python -m benchmarks.run --help
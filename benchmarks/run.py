@@ -0,0 +1,178 @@
+# coding utf8
+# Latency, peak memory and accuracy of the lucid detection functions
+#
+#   python -m benchmarks.run [--sensor 659x463 --zoom 1 --frames 10 ...]
+
+
+import argparse
+import json
+import math
+import multiprocessing
+import resource
+import time
+
+import numpy
+
+from lucid import FFT, meshGen, centerId, toolbox
+from benchmarks import synthetic
+
+
+def _find_loop(**kwargs):
+    def detect(img, scene):
+        label, x, y = FFT.find_loop(img, pixels_per_mm_horizontal=scene.pixels_per_mm, **kwargs)[:3]
+        return (x, y) if label == "Coord" else None
+    return detect
+
+
+def _find_loop_mesh(img, scene):
+    try:
+        label, x, y = centerId.find_loop_mesh(img, backend=meshGen.LUCID_BACKEND_NUMPY)
+    except IndexError:
+        # no contour straight above the centre, the ray fan has no start
+        return None
+    return (x, y) if label == "meshing" and x >= 0 and y >= 0 else None
+
+
+def _generate_meshing_info(img, scene):
+    try:
+        x0, y0, x1, y1 = meshGen.generate_meshing_info(img, method=meshGen.LUCID_RECT_BBOX, virtCenter=(-1, -1),
+                                                       backend=meshGen.LUCID_BACKEND_NUMPY)
+    except IndexError:
+        return None
+    # the box has a 5 pixels margin on each side, below -5 it holds the
+    # (-1, -1) point of a ray which found nothing
+    if x0 < -5 or y0 < -5:
+        return None
+    return ((x0 + x1) / 2.0, (y0 + y1) / 2.0)
+
+
+def _threshold(function):
+    def run(img, scene):
+        function(img)
+    return run
+
+
+#name -> function(image, scene) returning the centre (x, y), None when no
+#loop is found, or nothing for the functions without a centre
+CASES = {
+    "find_loop": _find_loop(),
+    "find_loop_float32": _find_loop(dtype=numpy.float32),
+    "find_loop_pyramid": _find_loop(scale="auto"),
+    "find_loop_mesh": _find_loop_mesh,
+    "generate_meshing_info": _generate_meshing_info,
+    "get_background_threshold": _threshold(toolbox.get_background_threshold),
+    "get_robust_background_threshold": _threshold(toolbox.get_robust_background_threshold),
+    "threshold_adaptive": _threshold(lambda img: toolbox.threshold_adaptive(img, 21, "mean")),
+}
+
+
+def _peak_child(function, img, scene, queue):
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    function(img, scene)
+    # kilobytes on Linux
+    queue.put(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before)
+
+
+def peak_memory(function, img, scene):
+    """Peak resident memory increase in bytes of one call, measured in a
+    forked process (0 when it could not be measured)"""
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_peak_child, args=(function, img, scene, queue))
+    process.start()
+    process.join()
+    if process.exitcode != 0 or queue.empty():
+        return 0
+    return max(queue.get(), 0) * 1024
+
+
+def benchmark(name, scenes, repeat=3, memory=True, seed=0):
+    """Run case name on a frame of each scene
+
+    :returns: dict with the latencies in seconds (best of repeat per frame,
+              median and max over the frames), the peak memory of the first
+              frame, and the centre errors in pixels for the detection
+              functions (misses counted apart)
+    """
+    function = CASES[name]
+    times = []
+    errors = []
+    misses = 0
+    for i, scene in enumerate(scenes):
+        img = scene.render(seed + i)
+        best = None
+        for r in range(repeat):
+            start = time.time()
+            centre = function(img, scene)
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        times.append(best)
+        if centre is not None:
+            cx, cy = scene.centre
+            errors.append(math.hypot(centre[0] - cx, centre[1] - cy))
+        elif name.startswith("find_loop") or name == "generate_meshing_info":
+            misses += 1
+    result = {
+        "name": name,
+        "sensor": "%dx%d" % (scenes[0].width, scenes[0].height),
+        "zoom": scenes[0].zoom,
+        "frames": len(scenes),
+        "median_s": float(numpy.median(times)),
+        "max_s": max(times),
+        "peak_bytes": peak_memory(function, scenes[0].render(seed), scenes[0]) if memory else None,
+    }
+    if errors or misses:
+        result["misses"] = misses
+        result["mean_error_px"] = float(numpy.mean(errors)) if errors else None
+        result["max_error_px"] = max(errors) if errors else None
+    return result
+
+
+def report(results):
+    """Text table of benchmark results"""
+    lines = ["%-32s %-10s %5s %10s %10s %9s %8s %8s %6s" % (
+        "case", "sensor", "zoom", "median ms", "max ms", "peak MB", "mean px", "max px", "miss")]
+    for r in results:
+        def number(key, fmt, scale=1.0):
+            value = r.get(key)
+            return fmt % (value * scale) if value is not None else "-"
+        lines.append("%-32s %-10s %5s %10s %10s %9s %8s %8s %6s" % (
+            r["name"], r["sensor"], r["zoom"], number("median_s", "%.1f", 1e3), number("max_s", "%.1f", 1e3),
+            number("peak_bytes", "%.1f", 1.0 / 2**20), number("mean_error_px", "%.1f"),
+            number("max_error_px", "%.1f"), r.get("misses", "-")))
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks of the lucid detection functions on synthetic frames")
+    parser.add_argument("--case", action="append", choices=sorted(CASES),
+                        help="case to run, repeat for several (all by default)")
+    parser.add_argument("--sensor", action="append", help="sensor size, one of %s or WxH (repeatable)"
+                        % ", ".join(sorted(synthetic.SENSORS)))
+    parser.add_argument("--zoom", action="append", type=float, help="zoom level (repeatable, 1 by default)")
+    parser.add_argument("--frames", type=int, default=10, help="frames per case")
+    parser.add_argument("--repeat", type=int, default=3, help="timed calls per frame, the best is kept")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the scenes and of the noise")
+    parser.add_argument("--no-memory", action="store_true", help="skip the peak memory measurement")
+    parser.add_argument("--json", action="store_true", help="JSON lines output")
+    options = parser.parse_args(argv)
+
+    sensors = []
+    for sensor in options.sensor or ["659x463"]:
+        if sensor not in synthetic.SENSORS:
+            sensor = tuple(int(n) for n in sensor.split("x"))
+        sensors.append(sensor)
+    results = []
+    for sensor in sensors:
+        for zoom in options.zoom or [1.0]:
+            scenes = synthetic.scenes(options.frames, sensor, zoom, options.seed)
+            for name in options.case or sorted(CASES):
+                result = benchmark(name, scenes, options.repeat, not options.no_memory, options.seed)
+                if options.json:
+                    print json.dumps(result, sort_keys=True)
+                results.append(result)
+    if not options.json:
+        print report(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+# coding utf8
+# Parametric synthetic loop images with known centres
+
+
+import math
+import numpy
+import scipy.ndimage
+
+#Sensor sizes (width, height)
+SENSORS = {
+    "659x463": (659, 463),
+    "1360x1024": (1360, 1024),
+    "2048x1536": (2048, 1536),
+}
+#Pixels per mm of a 659 pixels wide image at zoom 1 (FFT.PIXELS_PER_MM_HOR)
+PIXELS_PER_MM = 320.0
+
+
+class Scene(object):
+    """Parameters of a synthetic frame, all lengths in mm
+
+    The field of view does not depend on the sensor size: a larger sensor
+    gives more pixels per mm, as does a higher zoom.
+
+    :param width, height: sensor size in pixels
+    :param zoom: magnification, relative to PIXELS_PER_MM
+    :param loop: semi axes of the loop ellipse
+    :param angle: rotation of the loop in degrees
+    :param offset: loop centre position relative to the image centre
+    :param ring: thickness of the loop border
+    :param pin: width of the pin holding the loop, from the left edge
+    :param mesh: pitch of the mesh texture inside the loop, 0 for none
+    :param mesh_contrast: grey levels of the mesh lines
+    :param noise: standard deviation of the sensor noise in grey levels
+    :param gradient: illumination change across the image in grey levels
+    :param background: mean grey level of the background
+    :param blur: optics blur in pixels
+    """
+    def __init__(self, width=659, height=463, zoom=1.0, loop=(0.2, 0.15), angle=0.0, offset=(0.0, 0.0),
+                 ring=0.025, pin=0.04, mesh=0.03, mesh_contrast=6.0, noise=4.0, gradient=20.0,
+                 background=120.0, blur=1.0):
+        self.width = width
+        self.height = height
+        self.zoom = zoom
+        self.loop = loop
+        self.angle = angle
+        self.offset = offset
+        self.ring = ring
+        self.pin = pin
+        self.mesh = mesh
+        self.mesh_contrast = mesh_contrast
+        self.noise = noise
+        self.gradient = gradient
+        self.background = background
+        self.blur = blur
+
+    @property
+    def pixels_per_mm(self):
+        return PIXELS_PER_MM * self.zoom * self.width / 659.0
+
+    @property
+    def centre(self):
+        """Ground truth loop centre (x, y) in pixels"""
+        ppm = self.pixels_per_mm
+        return (self.width / 2.0 + self.offset[0] * ppm, self.height / 2.0 + self.offset[1] * ppm)
+
+    def render(self, seed=0, dtype=numpy.uint8):
+        """Frame of the scene, sensor noise drawn from seed"""
+        rng = numpy.random.RandomState(seed)
+        ppm = self.pixels_per_mm
+        cx, cy = self.centre
+        yy, xx = numpy.mgrid[:self.height, :self.width].astype(numpy.float32)
+        img = self.background + self.gradient * (xx / self.width - 0.5)
+
+        # loop frame coordinates, in mm
+        t = math.radians(self.angle)
+        u = ((xx - cx) * math.cos(t) + (yy - cy) * math.sin(t)) / ppm
+        v = (-(xx - cx) * math.sin(t) + (yy - cy) * math.cos(t)) / ppm
+        a, b = self.loop
+        r = numpy.hypot(u / a, v / b)
+        inside = r < 1
+        if self.mesh > 0:
+            lines = ((u % self.mesh) < self.mesh / 6.0) | ((v % self.mesh) < self.mesh / 6.0)
+            img[inside & lines] -= self.mesh_contrast
+        ring = self.ring / min(a, b)
+        img[(r >= 1 - ring) & (r < 1)] = self.background * 0.4
+        # pin from the left edge to the loop
+        pin = (abs(v) < self.pin / 2) & (u < -a * (1 - ring))
+        img[pin] = self.background * 0.3
+
+        if self.blur > 0:
+            img = scipy.ndimage.gaussian_filter(img, self.blur)
+        img += rng.normal(0, self.noise, img.shape)
+        if numpy.dtype(dtype) == numpy.uint8:
+            return numpy.clip(img, 0, 255).astype(numpy.uint8)
+        return img.astype(dtype)
+
+
+def scenes(count, sensor="659x463", zoom=1.0, seed=0, **kwargs):
+    """count scenes with random loop sizes, angles and offsets (repeatable from seed)"""
+    rng = numpy.random.RandomState(seed)
+    width, height = SENSORS.get(sensor, sensor)
+    result = []
+    for i in range(count):
+        a = rng.uniform(0.12, 0.2)
+        b = a * rng.uniform(0.6, 1.0)
+        params = dict(loop=(a, b), angle=rng.uniform(-20, 20),
+                      offset=(rng.uniform(-0.05, 0.05), rng.uniform(-0.05, 0.05)))
+        params.update(kwargs)
+        result.append(Scene(width, height, zoom, **params))
+    return result
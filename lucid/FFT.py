@@ -1,17 +1,40 @@
-import os
 import sys
 import numpy
-import pylab
 import scipy.ndimage
 import myutils as utils
-import scipy.stats
-import mahotas.polygon
 import toolbox
+import instrument
+
+#Loaded on first use
+pylab = utils.lazy_import("pylab")
 import types
 import math
+import collections
+import threading
+import tempfile
+try:
+    # single precision transforms, scipy >= 1.4
+    import scipy.fft as fftpack
+except ImportError:
+    fftpack = numpy.fft
 
 LOOP_MAX_WIDTH = 400*1E-3 #400 microns
 PIXELS_PER_MM_HOR = 320
+MASK_CACHE_SIZE = 8
+#Image shapes whose buffers a LoopFinder keeps
+WORKSPACE_SHAPES = 4
+THRESHOLD_OFFSETS = (20, 15, 10, 5, 0)
+MIN_LOOP_PIXELS = 50
+#Sensor width the default parameters were tuned for
+REFERENCE_WIDTH = 659
+#Memory ceiling in bytes of the working arrays of find_loop (see tiled_gradient),
+#None to process whole images at once
+MAX_TILE_BYTES = None
+#Working memory of tiled_gradient per pixel of a band of rows
+TILE_BYTES_PER_PIXEL = 64
+
+_mask_cache = collections.OrderedDict()
+_mask_cache_lock = threading.Lock()
 
 """
 def rgb2gray(rgb):
@@ -23,107 +46,611 @@ def img2float(fn):
     im = scipy.misc.imread(fn, flatten=True)
     return im #return rgb2gray(im) 
 
-def show_img(img,show=True, save=False, xy=None):
-    #if show:
-    #  pylab.imshow(img)
-    #  pylab.gray()
-    #  pylab.show()
-    filename = os.tempnam()+".png"
-    pylab.imsave(filename, img, cmap=pylab.cm.Greys_r)
+def overlay(img, xy=None, size=5):
+    """Grey levels RGB uint8 rendering of img (black to white from its minimum
+    to its maximum), with a red square of 2*size+1 pixels at xy"""
+    img = numpy.asarray(img, numpy.float64)
+    low, high = img.min(), img.max()
+    grey = numpy.zeros(img.shape, numpy.uint8)
+    if high > low:
+        grey[...] = (img - low) * (255.0 / (high - low))
+    rgb = numpy.dstack((grey, grey, grey))
     if xy is not None:
-      x0 = xy[0]-5
-      y0 = xy[1]-5
-      x1 = x0+5
-      y1 = y0+5
-      os.system("convert %s -fill red -draw 'rectangle %d,%d,%d,%d' %s_" % (filename, x0, y0, x1, y1, filename)) 
-      os.system("mv %s_ %s" % (filename, filename)) 
+        x, y = xy
+        rgb[max(y - size, 0):y + size + 1, max(x - size, 0):x + size + 1] = (255, 0, 0)
+    return rgb
+
+def show_img(img,show=True, save=False, xy=None, filename=None):
+    """Display img with pylab, with a red marker at xy. With save the
+    rendering is kept as a PNG file, filename or else a temporary file
+    whose name is printed. Returns the file name (None without save)."""
+    rgb = overlay(img, xy)
+    if save:
+      if filename is None:
+        with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as f:
+          pylab.imsave(f, rgb, format="png")
+        filename = f.name
+        print filename
+      else:
+        pylab.imsave(filename, rgb)
     if show:
-      os.system("display %s" % filename)
-    if not save:
-      os.unlink(filename)
-    else:
-      print filename
+      pylab.figure()
+      pylab.imshow(rgb)
+      pylab.show()
+    return filename if save else None
+
+class DebugTrace(object):
+    """Intermediate images of a find_loop call, kept in memory
+
+    Each stage is a copy of the image, taken in order: "smooth",
+    "background" (not in tiled mode, which has no such full image),
+    "gradient", then for each tried offset "threshold" and "opening", then
+    "loop" (the opening finally used), "crop" (its part kept for the centre
+    computation). Nothing is rendered until render or
+    overlay is called, matplotlib being imported then.
+
+    Attributes: stages, list of (name, array), and marker, the (x, y)
+    result in the pixels of the images (or None), roi, the window
+    (x0, y0, x1, y1) the images come from in roi and pyramid modes.
+    """
+    def __init__(self):
+        self.stages = []
+        self.marker = None
+        self.roi = None
+
+    def add(self, name, img):
+        """Keep a copy of img as stage name"""
+        self.stages.append((name, numpy.array(img)))
+
+    def names(self):
+        """Stage names, in order"""
+        return [name for name, img in self.stages]
+
+    def __getitem__(self, name):
+        """Image of the last stage called name"""
+        for stage, img in reversed(self.stages):
+            if stage == name:
+                return img
+        raise KeyError(name)
+
+    def overlay(self, name="crop", size=5):
+        """RGB rendering of stage name with the result marker, see overlay"""
+        return overlay(self[name], self.marker, size)
+
+    def render(self, show=True, prefix=None):
+        """Display every stage with pylab, the marker being drawn on the
+        "crop" stage, and save them as prefix + "NN_name.png" if prefix is
+        given. Returns the saved file names."""
+        filenames = []
+        for i, (name, img) in enumerate(self.stages):
+            xy = self.marker if name == "crop" else None
+            if prefix is not None:
+                filename = "%s%02d_%s.png" % (prefix, i, name)
+                filenames.append(filename)
+                show_img(img, show=False, save=True, xy=xy, filename=filename)
+            if show:
+                pylab.figure()
+                pylab.title(name)
+                pylab.imshow(overlay(img, xy))
+        if show:
+            pylab.show()
+        return filenames
+
+def _trace(debug, name, img):
+    if isinstance(debug, DebugTrace):
+        debug.add(name, img)
+
+@instrument.measured("find_loop")
+def find_loop(img, debug=False, pixels_per_mm_horizontal=PIXELS_PER_MM_HOR, chi_angle=0,
+              offsets=THRESHOLD_OFFSETS, min_pixels=MIN_LOOP_PIXELS, roi=None, scale=1,
+              max_bytes=None, workspace=None, dtype=None, return_hull=False, shape=None,
+              buffer_dtype=numpy.uint8):
+    """Find the loop centre, returns ("Coord", x, y) or ("No loop detected", -1, -1)
+
+    :param debug: True to collect the intermediate images in a DebugTrace
+                  returned as an extra last element of the result, or a
+                  DebugTrace to fill (the result is then unchanged)
+
+    :param roi: only process the window (x0, y0, x1, y1) of the image, or
+                "auto" for the window given by auto_roi. The window can be
+                slightly enlarged (see fft_friendly_roi). The returned
+                coordinates are full frame pixels.
+    :param scale: pyramid mode when > 1 (and no roi given): the loop is
+                  first found on the image downsampled by scale, then only
+                  the window around it (see pyramid_roi) is processed at
+                  full resolution. "auto" picks it from the image width
+                  (see pyramid_scale).
+    :param max_bytes: memory ceiling of the working arrays (MAX_TILE_BYTES
+                      by default): the stages up to the gradient are then
+                      computed by bands of rows (see tiled_gradient) and the
+                      openings as well, only the uint8 gradient and the
+                      boolean openings being full images. The centre is the
+                      same to a pixel.
+    :param workspace: LoopFinder whose buffers hold the intermediate images,
+                      allocated on each call if None
+    :param dtype: floating point type of the processing from the Gaussian
+                  filter on, numpy.float32 halves the memory traffic (and
+                  moves the centre by a pixel at most). By default the type
+                  of img, or float64 for integer images: the Gaussian filter
+                  is where the pixels are converted.
+    :param return_hull: also return the convex hull of the loop (see
+                        locate_loop), in full frame pixels
+    :param shape: when given, img is a frame buffer (bytes, memoryview, any
+                  object exporting the buffer protocol) of this (height,
+                  width) and of pixel type buffer_dtype, used without copy
+                  (see toolbox.buffer2array)
+    """
+    if debug is True:
+        trace = DebugTrace()
+        return find_loop(img, trace, pixels_per_mm_horizontal, chi_angle, offsets, min_pixels, roi, scale,
+                         max_bytes, workspace, dtype, return_hull, shape, buffer_dtype) + (trace,)
 
-def find_loop(img, debug=False, pixels_per_mm_horizontal=PIXELS_PER_MM_HOR, chi_angle=0):
-    if type(img) == types.StringType:
+    if shape is not None:
+        raw_img = toolbox.buffer2array(img, shape, buffer_dtype)
+    elif type(img) == types.StringType:
         raw_img = img2float(img)
     else:
         # already a numpy array
         raw_img = img
 
-    im = scipy.ndimage.gaussian_filter(raw_img, 1)
+    if scale == "auto":
+        scale = pyramid_scale(raw_img.shape)
+    if isinstance(roi, str):
+        roi = auto_roi(raw_img, chi_angle, pixels_per_mm_horizontal)
+    elif roi is None and scale > 1:
+        roi = pyramid_roi(raw_img, scale, pixels_per_mm_horizontal, chi_angle, offsets, min_pixels)
+    if roi is not None:
+        instrument.lap("roi")
+        x0, y0, x1, y1 = fft_friendly_roi(roi, raw_img.shape)
+        if isinstance(debug, DebugTrace):
+            debug.roi = (x0, y0, x1, y1)
+        result = find_loop(raw_img[y0:y1, x0:x1], debug, pixels_per_mm_horizontal, chi_angle, offsets, min_pixels,
+                           max_bytes=max_bytes, workspace=workspace, dtype=dtype, return_hull=return_hull)
+        if result[0] != "Coord":
+            return result
+        if return_hull:
+            return (result[0], int(result[1] + x0), int(result[2] + y0), result[3] + (x0, y0))
+        return (result[0], int(result[1] + x0), int(result[2] + y0))
+
+    if max_bytes is None:
+        max_bytes = MAX_TILE_BYTES
+    dtype = _work_dtype(raw_img.dtype, dtype)
+    if max_bytes is not None:
+        imgnumpy = tiled_gradient(raw_img, max_bytes, dtype, workspace)
+    else:
+        im = gaussian_smooth(raw_img, _empty(workspace, "smooth", raw_img.shape, dtype))
+        _trace(debug, "smooth", im)
+        instrument.lap("filter")
+
+        imgnumpy = subtract_background(im, workspace)
+        _trace(debug, "background", imgnumpy)
+        instrument.lap("fft")
+
+        imgnumpy = gradient_magnitude(imgnumpy, workspace)
+    _trace(debug, "gradient", imgnumpy)
+    instrument.lap("gradient")
+
+    return locate_loop(imgnumpy, debug, pixels_per_mm_horizontal, chi_angle, offsets, min_pixels, max_bytes,
+                       workspace, return_hull)
+
+@instrument.measured("find_loop_batch")
+def find_loop_batch(stack, pixels_per_mm_horizontal=PIXELS_PER_MM_HOR, chi_angle=0,
+                    offsets=THRESHOLD_OFFSETS, min_pixels=MIN_LOOP_PIXELS, roi=None, max_bytes=None,
+                    dtype=None):
+    """Run find_loop over a stack of frames (e.g. one per omega angle)
+
+    The filtering, background subtraction and gradient stages are computed
+    in one pass over the whole stack; only the threshold search and the
+    loop localisation remain per frame. With a memory ceiling the frames
+    are processed one at a time instead, by bands of rows.
+
+    :param stack: frames to process
+    :type stack: (N, H, W) numpy array, or list of image paths / 2D arrays
+    :param roi: window (x0, y0, x1, y1) processed in every frame
+    :param max_bytes: memory ceiling of the working arrays, see find_loop
+    :param dtype: floating point type of the processing, see find_loop
+    :returns: list of find_loop results, one per frame
+    """
+    if isinstance(stack, (list, tuple)):
+        stack = numpy.array([img2float(fn) if type(fn) == types.StringType else fn for fn in stack])
+
+    x0, y0 = 0, 0
+    if roi is not None:
+        x0, y0, x1, y1 = fft_friendly_roi(roi, stack.shape)
+        stack = stack[:, y0:y1, x0:x1]
+
+    if max_bytes is None:
+        max_bytes = MAX_TILE_BYTES
+    dtype = _work_dtype(stack.dtype, dtype)
+    if max_bytes is not None:
+        mag = (tiled_gradient(frame, max_bytes, dtype) for frame in stack)
+    else:
+        im = gaussian_smooth(stack, dtype=dtype)
+        instrument.lap("filter")
+        im = subtract_background(im)
+        instrument.lap("fft")
+        mag = gradient_magnitude(im)
+        instrument.lap("gradient")
+    instrument.count("frames", len(stack))
+
+    results = []
+    for frame in mag:
+        label, x, y = locate_loop(frame, False, pixels_per_mm_horizontal, chi_angle, offsets, min_pixels, max_bytes)
+        results.append((label, x + x0, y + y0) if label == "Coord" else (label, x, y))
+    return results
+
+def fft_friendly_roi(roi, shape):
+    """Enlarge the window (x0, y0, x1, y1) so that its FFT sizes in
+    subtract_background are fast lengths (see myutils.next_fast_len),
+    staying within an image of the given shape when possible"""
+    x0, y0, x1, y1 = roi
+    height, width = shape[-2:]
+    # subtract_background crops (2, 3) and pads (4, 4) pixels
+    h = utils.next_fast_len(y1 - y0 + 2) - 2
+    w = utils.next_fast_len(x1 - x0 + 1) - 1
+    if h <= height:
+        y0 = max(min(y0, height - h), 0)
+        y1 = y0 + h
+    if w <= width:
+        x0 = max(min(x0, width - w), 0)
+        x1 = x0 + w
+    return (int(x0), int(y0), int(x1), int(y1))
+
+def pyramid_scale(shape):
+    """Downsampling factor bringing an image of this shape near REFERENCE_WIDTH"""
+    return max(1, int(round(shape[-1] / float(REFERENCE_WIDTH))))
+
+def pyramid_roi(img, scale, pixels_per_mm_horizontal=PIXELS_PER_MM_HOR, chi_angle=0,
+                offsets=THRESHOLD_OFFSETS, min_pixels=MIN_LOOP_PIXELS, half_size=None):
+    """Coarse level of the pyramid mode of find_loop
+
+    The loop is searched on img downsampled by scale (pixel sizes and
+    min_pixels being scaled accordingly), the window (x0, y0, x1, y1) of
+    half_size pixels (loop max width by default) around it at full
+    resolution is returned, or None if the coarse search found nothing.
+    """
+    small = utils.downsample(img, scale)
+    label, x, y = find_loop(small, False, pixels_per_mm_horizontal/float(scale), chi_angle,
+                            offsets, max(min_pixels // (scale*scale), 1))
+    if label != "Coord":
+        return None
+    if half_size is None:
+        half_size = int(LOOP_MAX_WIDTH*pixels_per_mm_horizontal)
+    height, width = img.shape
+    x = x*scale + scale//2
+    y = y*scale + scale//2
+    return (max(x - half_size, 0), max(y - half_size, 0), min(x + half_size, width), min(y + half_size, height))
 
-    if debug:
-        show_img(im)
+def auto_roi(img, chi_angle=0, pixels_per_mm_horizontal=PIXELS_PER_MM_HOR, scale=4, margin=None):
+    """Window (x0, y0, x1, y1) around the pin tip, where find_loop looks for the loop
 
-    im = im[1:-1,1:-2]
-    im = utils.expand(im,2,mode="mirror")
+    The sample is found on a scale times downsampled gradient image. The
+    window spans LOOP_MAX_WIDTH back from its tip (right end with chi_angle
+    0, bottom end otherwise), plus margin pixels (half the loop width by
+    default) on each side. Returns None if nothing stands out.
+    """
+    loop_max_width_pixels = int(LOOP_MAX_WIDTH*pixels_per_mm_horizontal)
+    if margin is None:
+        margin = loop_max_width_pixels // 2
+    height, width = img.shape
+    small = utils.downsample(img, scale)
+    if min(small.shape) < 8:
+        return None
+    mag = gradient_magnitude(scipy.ndimage.gaussian_filter(small, 1))
+    T = toolbox.get_robust_background_threshold(mag)
+    sample = scipy.ndimage.morphology.binary_opening(mag > T + THRESHOLD_OFFSETS[0])
+    if not sample.any():
+        return None
+    if chi_angle != 0:
+        sample = sample.T
+    columns = numpy.flatnonzero(sample.any(axis=0))
+    tip = (columns[-1] + 1) * scale
+    start = max(tip - loop_max_width_pixels, 0) // scale
+    rows = numpy.flatnonzero(sample[:, start:].any(axis=1))
+    a0, a1 = max(tip - loop_max_width_pixels - margin, 0), tip + margin
+    b0, b1 = max(rows[0] * scale - margin, 0), (rows[-1] + 1) * scale + margin
+    if chi_angle != 0:
+        a0, a1, b0, b1 = b0, b1, a0, a1
+    return (int(a0), int(b0), int(min(a1, width)), int(min(b1, height)))
 
-    mask = new_mask(im.shape, .7, .7, 5)
+class LoopFinder(object):
+    """find_loop with reusable intermediate images
 
-    i1f = numpy.fft.fft2(im)
-    i2f = numpy.multiply(i1f,mask)
-    res = numpy.fft.ifft2(i2f)
+    The images of the pipeline are kept in buffers owned by the finder, one
+    per stage and image shape, and written in place by the next calls with
+    frames of the same shape. Only the FFT outputs, the opening temporaries
+    and the small per frame arrays are still allocated on each call. The
+    buffers of the WORKSPACE_SHAPES most recently used image shapes are
+    kept (a frame uses two: its own and the padded one), so that windows
+    of varying sizes (roi or scale "auto") do not pile up buffers.
 
-    imgnumpy = im - res.real
-    if debug:
-        show_img(imgnumpy)
+    A finder is not meant to be shared between threads, keep one per thread.
 
-    dx = scipy.ndimage.sobel(imgnumpy,axis=0,mode='constant')  # horizontal derivative
-    dy = scipy.ndimage.sobel(imgnumpy,axis=1,mode='constant')  # vertical derivative
-    mag = numpy.hypot(dx,dy)  # magnitude
-    mag *= 255.0/numpy.max(mag)
-    if debug:
-        show_img(mag)
-    imgnumpy = numpy.uint8(mag)
+    :param pixels_per_mm_horizontal, chi_angle, offsets, min_pixels, max_bytes, dtype: as for find_loop
 
-    for offset in [20,15,10,5,0]:
-        T = toolbox.get_robust_background_threshold(imgnumpy)
-        thresholded = imgnumpy > (T+offset) 
-        if debug:
-            show_img(thresholded)
+    Results returned by __call__ never refer to the buffers, debug traces
+    keep copies of the intermediate images.
+    """
+    def __init__(self, pixels_per_mm_horizontal=PIXELS_PER_MM_HOR, chi_angle=0,
+                 offsets=THRESHOLD_OFFSETS, min_pixels=MIN_LOOP_PIXELS, max_bytes=None, dtype=None):
+        self.pixels_per_mm_horizontal = pixels_per_mm_horizontal
+        self.chi_angle = chi_angle
+        self.offsets = offsets
+        self.min_pixels = min_pixels
+        self.max_bytes = max_bytes
+        self.dtype = dtype
+        self._buffers = collections.OrderedDict()
 
-        binimg = scipy.ndimage.morphology.binary_opening(thresholded, iterations=2)
-        
-        if debug:
-            show_img(binimg)
+    def __call__(self, img, debug=False, roi=None, scale=1, return_hull=False, shape=None, buffer_dtype=numpy.uint8):
+        """Find the loop centre of img, see find_loop"""
+        return find_loop(img, debug, self.pixels_per_mm_horizontal, self.chi_angle, self.offsets,
+                         self.min_pixels, roi, scale, self.max_bytes, self, self.dtype, return_hull,
+                         shape, buffer_dtype)
 
-        if numpy.sum(binimg) > 50:
-          break
+    def buffer(self, name, shape, dtype):
+        """Workspace array for name, of this shape and dtype (content undefined)"""
+        shape = tuple(shape)
+        buffers = self._buffers.pop(shape, None)
+        if buffers is None:
+            buffers = {}
+            while len(self._buffers) >= WORKSPACE_SHAPES:
+                self._buffers.popitem(last=False)
+        self._buffers[shape] = buffers
+        key = (name, numpy.dtype(dtype))
+        buf = buffers.get(key)
+        if buf is None:
+            buf = buffers[key] = numpy.empty(shape, dtype=dtype)
+        return buf
+
+    def clear(self):
+        """Release all the buffers"""
+        self._buffers.clear()
+
+def _work_dtype(img_dtype, dtype=None):
+    """Processing type of find_loop and find_loop_batch: dtype if given,
+    else img_dtype for floating point images, float64 otherwise"""
+    if dtype is not None:
+        return dtype
+    return img_dtype if numpy.issubdtype(img_dtype, numpy.floating) else numpy.float64
+
+def _empty(workspace, name, shape, dtype):
+    """Buffer of workspace (a LoopFinder), or a new array without workspace"""
+    if workspace is None:
+        return numpy.empty(shape, dtype=dtype)
+    return workspace.buffer(name, shape, dtype)
+
+def gaussian_smooth(img, output=None, dtype=None):
+    """Gaussian filter (sigma 1) of the last two axes of a (stack of) image(s)
+
+    The result is of type dtype (the type of output, or of img by default),
+    the only conversion of the image."""
+    # no smoothing across the frame axis
+    sigma = (0,)*(img.ndim-2) + (1, 1)
+    if output is not None:
+        scipy.ndimage.gaussian_filter(img, sigma, output=output)
+        return output
+    return scipy.ndimage.gaussian_filter(img, sigma, output=dtype)
+
+def subtract_background(im, workspace=None):
+    """Remove the low frequency background of a (stack of) filtered image(s)"""
+    im = im[..., 1:-1, 1:-2]
+    shape = im.shape[:-2] + (im.shape[-2]+4, im.shape[-1]+4)
+    dtype = _work_dtype(im.dtype)
+    im = utils.expand(im, 2, mode="mirror", out=_empty(workspace, "expand", shape, dtype))
+
+    # the image is real: only the half spectrum is needed
+    mask = get_mask(im.shape[-2:], .7, .7, 5, half=True, dtype=im.dtype)
+
+    # complex64 for float32 images, with scipy.fft
+    i1f = fftpack.rfft2(im)
+    i1f *= mask
+    res = fftpack.irfft2(i1f, s=im.shape[-2:])
+    del i1f
+
+    # the padded image is a copy, overwritten in place
+    return numpy.subtract(im, res, out=im)
+
+def _sobel(img, axis, output=None):
+    """Sobel derivative of the last two axes of img, axis being -2 or -1
+
+    Same as scipy.ndimage.sobel(mode='constant') on a 2D image, but does not
+    smooth across the leading (frame) axis of a stack."""
+    other = -1 if axis == -2 else -2
+    out = scipy.ndimage.correlate1d(img, [-1, 0, 1], axis, output=output, mode='constant')
+    if output is not None:
+        out = output
+    scipy.ndimage.correlate1d(out, [1, 2, 1], other, output=out, mode='constant')
+    return out
+
+def _magnitude(img, dx=None, dy=None):
+    dx = _sobel(img, -2, dx)  # horizontal derivative
+    dy = _sobel(img, -1, dy)  # vertical derivative
+    return numpy.hypot(dx, dy, out=dx)  # magnitude
+
+def gradient_magnitude(imgnumpy, workspace=None):
+    """Sobel gradient magnitude scaled to 0-255 per frame, as uint8"""
+    mag = _magnitude(imgnumpy, _empty(workspace, "dx", imgnumpy.shape, imgnumpy.dtype),
+                     _empty(workspace, "dy", imgnumpy.shape, imgnumpy.dtype))
+    mag *= 255.0/numpy.max(mag, axis=(-2, -1), keepdims=True)
+    out = _empty(workspace, "magnitude", mag.shape, numpy.uint8)
+    numpy.copyto(out, mag, casting="unsafe")
+    return out
+
+def _fourier(a, b, n, sign):
+    """exp(sign*2i*pi*a*b/n) for all the pairs of the integer vectors a and b"""
+    return numpy.exp((sign * 2j * numpy.pi / n) * (numpy.outer(a, b) % n))
+
+def tiled_gradient(img, max_bytes, dtype=None, workspace=None):
+    """gradient_magnitude(subtract_background(gaussian_smooth(img))) of a 2D
+    image, without any full size floating point image
+
+    The three stages are run by bands of rows which fit in max_bytes
+    (TILE_BYTES_PER_PIXEL per pixel): the Gaussian filter and the Sobel
+    derivatives read halos of 4 and 1 rows, the padded image of
+    subtract_background is gathered row by row from the filtered bands.
+    The background mask only keeps a few low frequencies (those where its
+    profiles are not zero), so its spectrum and the background rows are
+    computed as partial DFTs, accumulated then evaluated band by band.
+    The bands are processed three times: for the spectrum, the maximum of
+    the gradient, then the scaled uint8 gradient. Only the latter is full
+    size (a workspace buffer if workspace is given). The result matches
+    the whole image one to the rounding of the transforms.
+    """
+    height, width = img.shape
+    dtype = _work_dtype(img.dtype, dtype)
+    # rows and columns of img read by each pixel of the padded image
+    # (crop then mirror expansion, see subtract_background)
+    rows = utils.mirror_index(height - 2, 2) + 1
+    cols = utils.mirror_index(width - 3, 2) + 1
+    n0, n1 = len(rows), len(cols)
+    row_bytes = TILE_BYTES_PER_PIXEL * n1
+
+    def padded(a0, a1):
+        # rows a0:a1 of the padded filtered image
+        need = rows[a0:a1]
+        s0, s1 = max(need.min() - 4, 0), min(need.max() + 5, height)
+        band = scipy.ndimage.gaussian_filter(img[s0:s1], 1, output=dtype)
+        return band[numpy.ix_(need - s0, cols)]
+
+    # the real part of ifft2(fft2(im)*mask), see half_mask
+    h0, h1 = mask_profiles((n0, n1), .7, .7, 5)
+    k0, k1 = numpy.flatnonzero(h0), numpy.flatnonzero(h1)
+    forward = _fourier(numpy.arange(n1), k1, n1, -1)
+    spectrum = numpy.zeros((len(k0), len(k1)), complex)
+    for r0, r1, a0, a1 in utils.tile_rows(n0, 0, max_bytes, row_bytes):
+        spectrum += _fourier(k0, numpy.arange(r0, r1), n0, -1).dot(padded(r0, r1).dot(forward))
+    spectrum *= numpy.outer(h0[k0], h1[k1]) / (n0 * n1)
+    inverse = spectrum.dot(_fourier(k1, numpy.arange(n1), n1, 1))
+    del forward, spectrum
+    instrument.lap("fft")
+
+    def bands():
+        for r0, r1, a0, a1 in utils.tile_rows(n0, 1, max_bytes, row_bytes):
+            band = padded(a0, a1)
+            background = _fourier(numpy.arange(a0, a1), k0, n0, 1).dot(inverse).real
+            numpy.subtract(band, background, out=band, casting="unsafe")
+            del background
+            yield r0, r1, _magnitude(band)[r0 - a0:r1 - a0]
+
+    peak = None
+    for r0, r1, mag in bands():
+        peak = mag.max() if peak is None else max(peak, mag.max())
+    factor = 255.0/peak
+    out = _empty(workspace, "magnitude", (n0, n1), numpy.uint8)
+    for r0, r1, mag in bands():
+        mag *= factor
+        numpy.copyto(out[r0:r1], mag, casting="unsafe")
+    return out
+
+def threshold_opening(imgnumpy, threshold, debug=False, max_bytes=None, output=None):
+    """Pixels above threshold, cleaned by a binary opening (2 erosions then
+    2 dilations), written to output if given
+
+    Computed by bands of rows when max_bytes is given (see
+    utils.apply_tiled), the opening reaches 4 pixels. debug is a DebugTrace
+    or False."""
+    _trace(debug, "threshold", imgnumpy > threshold)
+
+    if max_bytes is None:
+        binimg = scipy.ndimage.morphology.binary_opening(imgnumpy > threshold, iterations=2, output=output)
+        if output is not None:
+            binimg = output
     else:
-        return ("No loop detected", -1, -1)
+        binimg = utils.apply_tiled(
+            lambda tile: scipy.ndimage.morphology.binary_opening(tile > threshold, iterations=2),
+            imgnumpy, 4, max_bytes, output, bytes_per_pixel=4)
+    _trace(debug, "opening", binimg)
+    return binimg
+
+def locate_loop(imgnumpy, debug=False, pixels_per_mm_horizontal=PIXELS_PER_MM_HOR, chi_angle=0,
+                offsets=THRESHOLD_OFFSETS, min_pixels=MIN_LOOP_PIXELS, max_bytes=None, workspace=None,
+                return_hull=False):
+    """Threshold the gradient magnitude image and return the loop centre
 
-    min1, max1, min2, max2 = mahotas.bbox(binimg)
-    if debug:
-        show_img(binimg)
-    binimg2 = numpy.zeros_like(binimg)
-    loop_max_width_pixels = LOOP_MAX_WIDTH*pixels_per_mm_horizontal
+    The highest offset above the background threshold for which more than
+    min_pixels pixels survive the opening is used. As the opening only
+    removes pixels, offsets leaving min_pixels or less above the threshold
+    (known from the histogram) are skipped, and since the surviving count
+    decreases with the offset the remaining ones are bisected, trying the
+    lowest first: a frame without loop costs one opening.
+
+    The centre is the centroid of the convex hull of the loop pixels, with
+    return_hull the hull vertices ((N, 2) array of x, y) are returned as a
+    fourth element (None when no loop is found). The openings are computed
+    by bands of rows under max_bytes, see threshold_opening. debug is a
+    DebugTrace or False."""
+    T = toolbox.get_robust_background_threshold(imgnumpy)
+    counts = toolbox.uint8_histogram(imgnumpy)
+    levels = numpy.arange(256)
+    candidates = [offset for offset in sorted(offsets, reverse=True)
+                  if counts[levels > (T+offset)].sum() > min_pixels]
+    instrument.lap("threshold")
+    # the current and the tried openings
+    names = ["opening", "opening2"]
+    binimg = None
+    if candidates:
+        instrument.count("offsets_tried")
+        binimg = threshold_opening(imgnumpy, T+candidates[-1], debug, max_bytes,
+                                   _empty(workspace, names[0], imgnumpy.shape, bool))
+        if numpy.sum(binimg) <= min_pixels:
+            binimg = None
+    if binimg is None:
+        instrument.lap("opening")
+        return ("No loop detected", -1, -1, None) if return_hull else ("No loop detected", -1, -1)
+
+    # candidates[high] passes, binimg being its opening
+    low, high = 0, len(candidates)-1
+    while low < high:
+        middle = (low+high)//2
+        instrument.count("offsets_tried")
+        opened = threshold_opening(imgnumpy, T+candidates[middle], debug, max_bytes,
+                                   _empty(workspace, names[1], imgnumpy.shape, bool))
+        if numpy.sum(opened) > min_pixels:
+            high, binimg = middle, opened
+            names.reverse()
+        else:
+            low = middle+1
+
+    instrument.lap("opening")
+
+    min1, max1, min2, max2 = toolbox.bbox(binimg)
+    _trace(debug, "loop", binimg)
+    binimg2 = _empty(workspace, "loop", binimg.shape, bool)
+    binimg2.fill(False)
+    loop_max_width_pixels = int(LOOP_MAX_WIDTH*pixels_per_mm_horizontal)
     if chi_angle == 0:
       # remove 200 microns from right
       binimg2[min1:max1, max2-loop_max_width_pixels:max2]=binimg[min1:max1, max2-loop_max_width_pixels:max2]
     else:
       # remove 200 micros from top
       binimg2[max1-loop_max_width_pixels:max1,  min2:max2]=binimg[max1-loop_max_width_pixels:max1,  min2:max2]
-    if debug:
-        show_img(binimg2)
+    _trace(debug, "crop", binimg2)
     
-    min1, max1, min2, max2 = mahotas.bbox(binimg2)
-    bounded_img = binimg2[min1:max1, min2:max2]   
-    hull = mahotas.polygon.fill_convexhull(bounded_img)
-    cy, cx = map(int, scipy.ndimage.measurements.center_of_mass(hull))
-    x = int(min2)+cx
-    y = int(min1)+cy
-    if debug: 
-        show_img(binimg2, xy=(x,y))
+    min1, max1, min2, max2 = toolbox.bbox(binimg2)
+    bounded_img = binimg2[min1:max1, min2:max2]
+    hull = toolbox.convex_hull(toolbox.row_extremes(bounded_img)) + (min2, min1)
+    cx, cy = toolbox.polygon_centroid(hull)
+    x = int(cx)
+    y = int(cy)
+    if isinstance(debug, DebugTrace):
+        debug.marker = (x, y)
+    instrument.lap("hull")
     
+    if return_hull:
+        return ("Coord",x,y,hull)
     return ("Coord",x,y)
 
 def new_mask(shape,sigma,sigma2,mulsigma):
+    h0, h1 = mask_profiles(shape,sigma,sigma2,mulsigma)
+    return numpy.outer(h0,h1)
+
+def mask_profiles(shape,sigma,sigma2,mulsigma):
+    """Row and column profiles of new_mask, which is their outer product"""
     h = numpy.zeros(shape[0])
     w = numpy.zeros(shape[1])
 
-    h[(shape[0]//2)-(mulsigma*sigma):(shape[0]//2)+(mulsigma*sigma)]=1
-    w[(shape[1]//2)-(mulsigma*sigma2):(shape[1]//2)+(mulsigma*sigma2)]=1
+    h[int((shape[0]//2)-(mulsigma*sigma)):int((shape[0]//2)+(mulsigma*sigma))]=1
+    w[int((shape[1]//2)-(mulsigma*sigma2)):int((shape[1]//2)+(mulsigma*sigma2))]=1
 
     b1 = scipy.ndimage.filters.gaussian_filter(h,sigma)
     b2 = scipy.ndimage.filters.gaussian_filter(w,sigma2)
@@ -135,9 +662,43 @@ def new_mask(shape,sigma,sigma2,mulsigma):
     h0[shape[0] // 2:] = b1[:shape[0] - shape[0] // 2]
     h1[:shape[1] // 2] = b2[shape[1] - shape[1] // 2:]
     h1[shape[1] // 2:] = b2[:shape[1] - shape[1] // 2]
+    return h0, h1
+
+def half_mask(mask):
+    """Restrict a full spectrum mask to the rfft2 half spectrum
+
+    The mask is made symmetric first, so that irfft2(rfft2(im)*half_mask(mask))
+    equals ifft2(fft2(im)*mask).real for a real image."""
+    sym = numpy.roll(numpy.roll(mask[::-1, ::-1], 1, axis=0), 1, axis=1)
+    sym += mask
+    sym *= 0.5
+    return sym[:, :mask.shape[1]//2 + 1]
+
+def get_mask(shape, sigma, sigma2, mulsigma, half=False, dtype=numpy.float64):
+    """Same as new_mask, but cached by (shape, sigma, sigma2, mulsigma)
 
-    g = numpy.outer(h0,h1)
-    return g
+    The MASK_CACHE_SIZE most recently used masks are kept, the returned
+    arrays are read-only. With half=True the rfft2 half spectrum mask is
+    returned (see half_mask). The mask is computed in double precision and
+    converted to dtype. Safe to call from several threads."""
+    key = (tuple(shape), sigma, sigma2, mulsigma, half, numpy.dtype(dtype))
+    with _mask_cache_lock:
+        mask = _mask_cache.pop(key, None)
+        if mask is not None:
+            _mask_cache[key] = mask
+            return mask
+    # built outside of the lock, two threads may both build a new mask
+    mask = new_mask(shape, sigma, sigma2, mulsigma)
+    if half:
+        mask = half_mask(mask)
+    mask = mask.astype(dtype, copy=False)
+    mask.setflags(write=False)
+    with _mask_cache_lock:
+        _mask_cache.pop(key, None)
+        while len(_mask_cache) >= MASK_CACHE_SIZE:
+            _mask_cache.popitem(last=False)
+        _mask_cache[key] = mask
+    return mask
 
 if __name__ == '__main__':
     for filename in sys.argv[1:]:
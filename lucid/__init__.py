@@ -2,3 +2,5 @@ from .centerId import *
 from .toolbox import *
 from .meshGen import *
 from .FFT import *
+from .tracker import *
+from .framestack import *
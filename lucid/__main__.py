@@ -0,0 +1,168 @@
+# coding utf8
+# Batch loop detection over image files
+#
+#   python -m lucid [--method find_loop] [--processes N] image_or_directory ...
+#   python -m lucid serve [--socket PATH] ...   (centring daemon, see daemon.py)
+#
+# Results are written as JSON lines, in the order of the input files, the
+# throughput is reported on stderr. Each frame of .npy stacks and of raw
+# stacks with a JSON sidecar (see framestack.FrameStack) is processed.
+
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+from lucid import FFT, centerId, meshGen
+from lucid.framestack import FrameStack, is_stack
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff")
+METHODS = ("find_loop", "find_loop_mesh", "generate_meshing_info")
+BACKENDS = {"opencv": meshGen.LUCID_BACKEND_OPENCV, "numpy": meshGen.LUCID_BACKEND_NUMPY}
+
+#Options, LoopFinder and opened stacks of a worker process, set by _init_worker
+_options = None
+_finder = None
+_stacks = {}
+
+
+def list_images(paths):
+    """(file, frame) of each image of paths, frame being the index in a
+    stack file or None. Directories are expanded (sorted, not recursive)."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, name) for name in sorted(os.listdir(path))
+                         if name.lower().endswith(IMAGE_EXTENSIONS) or is_stack(os.path.join(path, name)))
+        else:
+            files.append(path)
+    images = []
+    for path in files:
+        if is_stack(path):
+            images.extend((path, frame) for frame in range(len(FrameStack(path))))
+        else:
+            images.append((path, None))
+    return images
+
+
+def _init_worker(options):
+    global _options, _finder
+    _options = options
+    _finder = FFT.LoopFinder(options["pixels_per_mm"], options["chi_angle"])
+
+
+def _load(path, frame):
+    if frame is None:
+        # read by the detection function
+        return path
+    if path not in _stacks:
+        _stacks[path] = FrameStack(path)
+    return _stacks[path][frame]
+
+
+def process_file(image):
+    """Result of the detection on one (file, frame) image, as a JSON serialisable dict"""
+    path, frame = image
+    options = _options
+    start = time.time()
+    result = {"file": path}
+    if frame is not None:
+        result["frame"] = frame
+    try:
+        img = _load(path, frame)
+        if options["method"] == "find_loop":
+            label, x, y = _finder(img, roi=options["roi"], scale=options["scale"])
+            result.update(label=label, x=x, y=y)
+        elif options["method"] == "find_loop_mesh":
+            label, x, y = centerId.find_loop_mesh(img, zoom=options["zoom"], backend=options["backend"])
+            result.update(label=label, x=x, y=y)
+        else:
+            box = meshGen.generate_meshing_info(img, method=meshGen.LUCID_RECT_BBOX, zoom=options["zoom"],
+                                                virtCenter=(-1, -1), backend=options["backend"])
+            result["bbox"] = [int(v) for v in box]
+    except Exception as error:
+        result["error"] = "%s: %s" % (type(error).__name__, error)
+    for key in ("x", "y"):
+        if key in result:
+            result[key] = int(result[key])
+    result["seconds"] = time.time() - start
+    return result
+
+
+def run(images, options, processes=None, output=sys.stdout, chunksize=1):
+    """Process the (file, frame) images (see list_images) over a
+    pool of processes, writing one JSON line per image to output in order
+
+    :returns: (number of images, number of errors, elapsed seconds)
+    """
+    start = time.time()
+    errors = 0
+    if processes == 1:
+        _init_worker(options)
+        results = (process_file(image) for image in images)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(processes, _init_worker, (options,))
+        results = pool.imap(process_file, images, chunksize)
+    try:
+        for result in results:
+            errors += "error" in result
+            output.write(json.dumps(result, sort_keys=True) + "\n")
+            output.flush()
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return len(images), errors, time.time() - start
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv[:1] == ["serve"]:
+        from lucid import daemon
+        return daemon.main(argv[1:])
+    parser = argparse.ArgumentParser(prog="python -m lucid",
+                                     description="Loop detection over image files, JSON lines output")
+    parser.add_argument("paths", nargs="+", help="image or stack files, or directories of them")
+    parser.add_argument("--method", choices=METHODS, default="find_loop")
+    parser.add_argument("--processes", type=int, default=None, help="worker processes (number of CPUs by default)")
+    parser.add_argument("--chunksize", type=int, default=1, help="images sent to a worker at once")
+    parser.add_argument("--output", help="output file (stdout by default)")
+    parser.add_argument("--pixels-per-mm", type=float, default=FFT.PIXELS_PER_MM_HOR, help="find_loop only")
+    parser.add_argument("--chi-angle", type=float, default=0, help="find_loop only")
+    parser.add_argument("--scale", default="1", help="find_loop pyramid mode scale, or auto")
+    parser.add_argument("--roi", help="find_loop window x0,y0,x1,y1, or auto")
+    parser.add_argument("--zoom", type=int, default=0, help="meshing zoom level")
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default="opencv", help="meshing backend")
+    args = parser.parse_args(argv)
+
+    roi = args.roi
+    if roi is not None and roi != "auto":
+        roi = tuple(int(v) for v in roi.split(","))
+    options = {
+        "method": args.method,
+        "pixels_per_mm": args.pixels_per_mm,
+        "chi_angle": args.chi_angle,
+        "scale": args.scale if args.scale == "auto" else int(args.scale),
+        "roi": roi,
+        "zoom": args.zoom,
+        "backend": BACKENDS[args.backend],
+    }
+    images = list_images(args.paths)
+    output = open(args.output, "w") if args.output else sys.stdout
+    try:
+        count, errors, elapsed = run(images, options, args.processes, output, args.chunksize)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    sys.stderr.write("%d images (%d errors) in %.1f s, %.1f images/s\n"
+                     % (count, errors, elapsed, count / elapsed if elapsed > 0 else 0.0))
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
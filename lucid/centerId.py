@@ -7,14 +7,16 @@ __contact__ = "etienne.francois:esrf.fr"
 __copyright__ = "2013, ESRF"
 
 
-import opencv
-import cv
 import numpy
 #import pyFAI.splitBBox
-import pylab
 import scipy.ndimage
-from toolbox import displayCv,white_detect,erode,dilate,open_image,smooth,imgInfo2cvImage
+from myutils import lazy_import
+from toolbox import displayCv,white_detect,erode,dilate,open_image,smooth,imgInfo2cvImage,imgInfo2array
 import meshGen
+import instrument
+
+#Loaded on first use
+cv = lazy_import("cv")
 
 
 #================================================================================#
@@ -41,7 +43,8 @@ def find_face(imgInfo,showVisuals=False,zoom=0):
     return find_loop(imgInfo,showVisuals=showVisuals,zoom=zoom,faceFindProc=True)
 
 #Detection of loop with the meshing system
-def find_loop_mesh(imgInfo, showVisuals=False, zoom=0, virtCenter=(-1,-1)):
+@instrument.measured("find_loop_mesh")
+def find_loop_mesh(imgInfo, showVisuals=False, zoom=0, virtCenter=(-1,-1), minAngleStep=None, maxRays=None, backend=meshGen.LUCID_BACKEND_OPENCV, roi=None, scale=None, shape=None, bufferDtype=numpy.uint8):
     """|
     
     :param imgInfo: Information about the input image. Two types allowed yet : Image path or Numpy array
@@ -52,15 +55,45 @@ def find_loop_mesh(imgInfo, showVisuals=False, zoom=0, virtCenter=(-1,-1)):
     :type zoom: uint
     :param virtCenter: A virtual center if reqal center use is not wanted
     :type virtCenter: Tuple (uint,uint)
+    :param minAngleStep: Finest angle step in degrees for the adaptive ray fan (15 degrees halved until not greater than this), None for the fixed 15 degrees fan
+    :type minAngleStep: float
+    :param maxRays: Maximum number of rays cast per frame by the adaptive ray fan
+    :type maxRays: uint
+    :param backend: Image processing backend of generate_meshing_info
+    :type backend: meshGen.LUCID_BACKEND_OPENCV or meshGen.LUCID_BACKEND_NUMPY
+    :param roi: Only process this window of the image, returned coordinates are full frame pixels
+    :type roi: Tuple (x0,y0,x1,y1)
+    :param scale: Pyramid mode downsampling factor, see meshGen.generate_meshing_info
+    :type scale: uint
+    :param shape: When given, imgInfo is a frame buffer (bytes, memoryview, any object exporting the buffer protocol) of this shape, used without copy with the Numpy backend
+    :type shape: Tuple (uint,uint)
+    :param bufferDtype: Pixel type of a buffer imgInfo
+    :type bufferDtype: Numpy dtype
 
     :returns: (label,x,y) result from loop_detection function
 
     """
+    if shape is not None:
+        imgInfo = imgInfo2array(imgInfo,shape,bufferDtype)
+    if scale is None:
+        scale = meshGen.LUCID_PYRAMID_SCALES.get(zoom,1)
+    if roi is None and scale > 1:
+        roi = meshGen.pyramidWindow(imgInfo,scale,21+50*zoom,virtCenter,backend)
+    if roi is not None:
+        x0,y0,x1,y1 = roi
+        window = numpy.ascontiguousarray(imgInfo2array(imgInfo)[y0:y1,x0:x1])
+        if virtCenter != (-1,-1):
+            virtCenter = (virtCenter[0]-x0,virtCenter[1]-y0)
+        label,x,y = find_loop_mesh(window,showVisuals,zoom,virtCenter,minAngleStep,maxRays,backend,scale=1)
+        return label,x+x0,y+y0
     if showVisuals:
-        (x,y,x2,y2),imageClone,image3,store,virtCenter = meshGen.generate_meshing_info(imgInfo,method=meshGen.LUCID_CENTER_PROC,showVisuals=showVisuals,zoom=zoom,virtCenter=virtCenter)
+        (x,y,x2,y2),imageClone,image3,store,virtCenter = meshGen.generate_meshing_info(imgInfo,method=meshGen.LUCID_CENTER_PROC,showVisuals=showVisuals,zoom=zoom,virtCenter=virtCenter,minAngleStep=minAngleStep,maxRays=maxRays,backend=backend)
+        if backend == meshGen.LUCID_BACKEND_NUMPY:
+            imageClone = cv.GetImage(cv.fromarray(imageClone))
+            image3 = cv.GetImage(cv.fromarray(image3))
         cv.Rectangle(imageClone,(x,y),(x2,y2),cv.Scalar( 120, 120, 120 ))
     else:
-        (x,y,x2,y2),image3 = meshGen.generate_meshing_info(imgInfo,method=meshGen.LUCID_CENTER_PROC,showVisuals=showVisuals,zoom=zoom,virtCenter=virtCenter)
+        (x,y,x2,y2),image3 = meshGen.generate_meshing_info(imgInfo,method=meshGen.LUCID_CENTER_PROC,showVisuals=showVisuals,zoom=zoom,virtCenter=virtCenter,minAngleStep=minAngleStep,maxRays=maxRays,backend=backend)
    
     xres = x2-((x2-x)//2)
     yrestemp = -1
@@ -77,6 +110,7 @@ def find_loop_mesh(imgInfo, showVisuals=False, zoom=0, virtCenter=(-1,-1)):
         yres = y2-((y2-y)//2)
     else:
         yres = yrestemp2 - ((yrestemp2-yrestemp)//2)
+    instrument.lap("center")
     if showVisuals:
         for num in range(len(store)):
              cv.Line( image3, virtCenter, store[num],cv.Scalar( 120, 120, 120 ),2,8 );
@@ -0,0 +1,149 @@
+# coding utf8
+# Thin client of the lucid centring daemon (python -m lucid serve)
+#
+# Only uses the standard library, the frames are Numpy arrays (or any
+# object with shape and dtype exporting the buffer protocol), or bytes
+# with an explicit shape and pixel type (buffer_dtype).
+
+
+import json
+import socket
+import struct
+
+DEFAULT_SOCKET = "/tmp/lucid.sock"
+METHODS = ("find_loop", "find_loop_mesh", "generate_meshing_info", "ping")
+
+#Messages : header length (4 bytes, big endian), JSON header, then the
+#header "nbytes" bytes of frame pixels
+_LENGTH = struct.Struct(">I")
+
+
+class CentringError(RuntimeError):
+    """Error reported by the daemon for a request"""
+
+
+def _recv_into(sock, view):
+    pos = 0
+    while pos < len(view):
+        n = sock.recv_into(view[pos:], len(view) - pos)
+        if n == 0:
+            raise EOFError("connection closed")
+        pos += n
+
+
+def encode_header(header, nbytes=0, default=None):
+    """Length prefixed JSON header of a message with nbytes of payload
+    (see json.dumps for default, TypeError if header cannot be encoded)"""
+    data = json.dumps(dict(header, nbytes=nbytes), default=default).encode("utf8")
+    return _LENGTH.pack(len(data)) + data
+
+
+def send_message(sock, header, payload=None, default=None):
+    """Send header (a JSON serialisable dict, see encode_header) and
+    payload (buffer of bytes)"""
+    size = 0 if payload is None else getattr(payload, "nbytes", None) or len(payload)
+    sock.sendall(encode_header(header, size, default))
+    if size:
+        sock.sendall(payload)
+
+
+def recv_message(sock):
+    """Receive a message, returns (header, payload bytearray or None)
+
+    Raises EOFError when the connection is closed before a message."""
+    length = bytearray(_LENGTH.size)
+    _recv_into(sock, memoryview(length))
+    data = bytearray(_LENGTH.unpack(bytes(length))[0])
+    _recv_into(sock, memoryview(data))
+    header = json.loads(data.decode("utf8"))
+    payload = None
+    if header.get("nbytes"):
+        payload = bytearray(header["nbytes"])
+        _recv_into(sock, memoryview(payload))
+    return header, payload
+
+
+def _frame_bytes(frame):
+    flags = getattr(frame, "flags", None)
+    if flags is not None and not flags["C_CONTIGUOUS"]:
+        return frame.tobytes()
+    # no copy
+    return memoryview(frame).cast("B") if hasattr(memoryview, "cast") else frame
+
+
+class CentringClient(object):
+    """Connection to a centring daemon, one request at a time
+
+    Results are the ones of the lucid functions, tuples being sent back as
+    tuples (lists for the array parts, e.g. a find_loop hull).
+
+    :param path: Unix socket of the daemon
+    :param timeout: socket timeout in seconds, None to block
+    """
+    def __init__(self, path=DEFAULT_SOCKET, timeout=None):
+        self.path = path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(path)
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def call(self, method, frame=None, shape=None, buffer_dtype=None, file=None, offset=0, timeout=None, **kwargs):
+        """Run method of the daemon on a frame and return its result
+
+        :param frame: Numpy array, or bytes of a frame with shape and buffer_dtype
+        :param shape: (height, width), by default frame.shape
+        :param buffer_dtype: pixel type name (e.g. "uint8", "<u2"), by default
+                             frame.dtype.str (as find_loop's buffer_dtype, dtype
+                             being its processing type, passed in kwargs)
+        :param file: instead of frame, a file shared with the daemon (e.g.
+                     in /dev/shm) holding the frame at offset, mapped by the
+                     daemon without copy; shape and buffer_dtype are then required
+        :param timeout: seconds the daemon waits for the result
+        :param kwargs: keyword arguments of the lucid function
+        """
+        if file is not None and (shape is None or buffer_dtype is None):
+            raise ValueError("shape and buffer_dtype of the frame are required with file")
+        header = {"method": method, "kwargs": kwargs, "timeout": timeout}
+        payload = None
+        if frame is not None or file is not None:
+            if shape is None:
+                if not hasattr(frame, "shape"):
+                    raise ValueError("shape of the frame is required for a bytes frame")
+                shape = frame.shape
+            if buffer_dtype is None:
+                buffer_dtype = frame.dtype.str if hasattr(frame, "dtype") else "|u1"
+            header.update(shape=list(shape), buffer_dtype=str(buffer_dtype))
+        if file is not None:
+            header.update(file=file, offset=offset)
+        elif frame is not None:
+            payload = _frame_bytes(frame)
+        send_message(self.sock, header, payload)
+        response, _ = recv_message(self.sock)
+        if "error" in response:
+            raise CentringError(response["error"])
+        result = response["result"]
+        return tuple(result) if isinstance(result, list) else result
+
+    def ping(self):
+        """Daemon information (workers, pid)"""
+        return self.call("ping")
+
+    def find_loop(self, frame, **kwargs):
+        """FFT.find_loop on the daemon, see call"""
+        return self.call("find_loop", frame, **kwargs)
+
+    def find_loop_mesh(self, frame, **kwargs):
+        """centerId.find_loop_mesh on the daemon, see call"""
+        return self.call("find_loop_mesh", frame, **kwargs)
+
+    def generate_meshing_info(self, frame, **kwargs):
+        """meshGen.generate_meshing_info on the daemon, see call"""
+        return self.call("generate_meshing_info", frame, **kwargs)
@@ -0,0 +1,164 @@
+# coding utf8
+# Persistent centring daemon on a Unix socket
+#
+#   python -m lucid serve [--socket /tmp/lucid.sock] [--workers 4] [--warm 659x463]
+#
+# The process keeps its imports, the FFT mask cache and the LoopFinder
+# buffers of its worker threads from one request to the next; clients
+# (see client.CentringClient) only pay for the socket round trip and the
+# detection itself.
+
+
+import argparse
+import os
+import socket
+import sys
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+import numpy
+
+from client import DEFAULT_SOCKET, encode_header, recv_message
+from framestack import FrameStack
+from service import CentringService
+
+#Keyword arguments whose results cannot be sent back (debug traces, windows
+#displayed by the daemon)
+UNSUPPORTED_KWARGS = ("debug", "showVisuals")
+
+
+def _json_default(value):
+    if isinstance(value, numpy.generic):
+        return value.item()
+    if isinstance(value, numpy.ndarray):
+        return value.tolist()
+    raise TypeError("%r is not JSON serializable" % (value,))
+
+
+def _frame(header, payload):
+    """Frame of a request: its payload, or a view of the shared file it
+    names (None when the request has neither)"""
+    if "file" in header:
+        stack = FrameStack(header["file"], header["shape"], header["buffer_dtype"], header.get("offset", 0))
+        return stack[0]
+    return payload
+
+
+class CentringHandler(socketserver.BaseRequestHandler):
+    """Serve the requests of one connection until the client closes it"""
+
+    def handle(self):
+        while True:
+            try:
+                header, payload = recv_message(self.request)
+            except (EOFError, socket.error):
+                return
+            # encoded before sending, a result JSON cannot hold is an error response
+            try:
+                response = encode_header({"result": self.server.dispatch(header, payload)},
+                                         default=_json_default)
+            except Exception as error:
+                response = encode_header({"error": "%s: %s" % (type(error).__name__, error)})
+            try:
+                self.request.sendall(response)
+            except socket.error:
+                return
+
+
+class CentringDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Unix socket server running the requests on a CentringService
+
+    One thread per connection reads the frames, the detections run on the
+    worker threads of the service (which limits the jobs accepted at once,
+    the clients getting a ServiceBusy error beyond).
+
+    :param path: Unix socket, replaced if it exists
+    :param max_workers: Worker threads of the service
+    :param max_pending: Jobs accepted at once, see CentringService
+    :param mode: Permissions of the socket file
+    """
+    daemon_threads = True
+
+    def __init__(self, path=DEFAULT_SOCKET, max_workers=4, max_pending=None, mode=0o660):
+        if os.path.exists(path):
+            os.remove(path)
+        socketserver.UnixStreamServer.__init__(self, path, CentringHandler)
+        os.chmod(path, mode)
+        self.path = path
+        self.service = CentringService(max_workers, max_pending)
+
+    def dispatch(self, header, payload):
+        """Result of the request header with its frame payload"""
+        method = header.get("method")
+        if method == "ping":
+            return {"pid": os.getpid(), "workers": self.service.max_workers}
+        # JSON has no tuples, the lucid functions compare virtCenter, roi... with tuples
+        kwargs = dict((key, tuple(value) if isinstance(value, list) else value)
+                      for key, value in (header.get("kwargs") or {}).items())
+        if kwargs.get("dtype") is not None:
+            # processing type of find_loop, sent by name
+            kwargs["dtype"] = numpy.dtype(kwargs["dtype"])
+        unsupported = sorted(key for key in UNSUPPORTED_KWARGS if kwargs.get(key))
+        if unsupported:
+            raise ValueError("%s not supported by the daemon" % ", ".join(unsupported))
+        frame = _frame(header, payload)
+        if frame is None:
+            raise ValueError("%s request without a frame" % method)
+        if payload is not None:
+            # decoded without copy by the detection functions
+            shape = tuple(header["shape"])
+            if method == "find_loop":
+                kwargs.update(shape=shape, buffer_dtype=header["buffer_dtype"])
+            else:
+                kwargs.update(shape=shape, bufferDtype=header["buffer_dtype"])
+        if method == "find_loop":
+            future = self.service.find_loop(frame, **kwargs)
+        elif method == "find_loop_mesh":
+            future = self.service.find_loop_mesh(frame, **kwargs)
+        elif method == "generate_meshing_info":
+            future = self.service.generate_meshing_info(frame, **kwargs)
+        else:
+            raise ValueError("unknown method %r" % method)
+        return self.service.result(future, header.get("timeout"))
+
+    def warm(self, width, height, dtype=numpy.uint8):
+        """Run find_loop once on each worker thread on a width x height noise
+        frame, to fill the FFT mask cache and the worker buffers of that
+        size (see CentringService.warm)"""
+        frame = numpy.random.RandomState(0).randint(0, 256, (height, width)).astype(dtype)
+        self.service.warm(frame)
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        self.service.shutdown(False)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m lucid serve",
+                                     description="Centring daemon on a Unix socket, see lucid.client")
+    parser.add_argument("--socket", default=DEFAULT_SOCKET, help="socket path (%(default)s)")
+    parser.add_argument("--workers", type=int, default=4, help="worker threads")
+    parser.add_argument("--max-pending", type=int, default=None, help="jobs accepted at once")
+    parser.add_argument("--mode", default="660", help="octal permissions of the socket")
+    parser.add_argument("--warm", action="append", default=[], metavar="WxH",
+                        help="frame size to prepare the buffers for (repeatable)")
+    args = parser.parse_args(argv)
+
+    server = CentringDaemon(args.socket, args.workers, args.max_pending, int(args.mode, 8))
+    try:
+        for size in args.warm:
+            width, height = (int(n) for n in size.split("x"))
+            server.warm(width, height)
+        sys.stderr.write("lucid centring daemon on %s (pid %d, %d workers)\n"
+                         % (args.socket, os.getpid(), args.workers))
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
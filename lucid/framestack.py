@@ -0,0 +1,90 @@
+# coding utf8
+# Memory-mapped frame stacks for replay and benchmarking
+
+
+import json
+import os
+import numpy
+
+
+def sidecar_path(path):
+    """Name of the JSON header of a raw stack: path with a .json extension"""
+    return os.path.splitext(path)[0] + ".json"
+
+
+class FrameStack(object):
+    """Read-only stack of frames mapped from a .npy file or a raw file
+
+    Frames are views of the mapping: nothing is read from the disk until a
+    processing stage touches the pixels, and no copy or conversion is made.
+    They can be given as is to FFT.find_loop, centerId.find_loop_mesh or
+    meshGen.generate_meshing_info (numpy backend).
+
+    A raw file is described by its JSON sidecar (see sidecar_path), or by
+    the shape and dtype arguments:
+    {"shape": [frames, height, width], "dtype": "uint16", "offset": 0}
+    the offset being the size in bytes of a header to skip.
+
+    :param path: .npy or raw file
+    :param shape: (frames, height, width) or (height, width) of a raw file
+    :param dtype: pixel type of a raw file
+    :param offset: header size of a raw file
+    """
+    def __init__(self, path, shape=None, dtype=None, offset=0):
+        self.path = path
+        if path.lower().endswith(".npy"):
+            frames = numpy.load(path, mmap_mode="r")
+        else:
+            if shape is None or dtype is None:
+                with open(sidecar_path(path)) as f:
+                    header = json.load(f)
+                shape = header["shape"] if shape is None else shape
+                dtype = header["dtype"] if dtype is None else dtype
+                offset = header.get("offset", offset)
+            frames = numpy.memmap(path, numpy.dtype(dtype), "r", offset, tuple(shape))
+        if frames.ndim == 2:
+            frames = frames[numpy.newaxis]
+        if frames.ndim != 3:
+            raise ValueError("%s: expected a (frames, height, width) stack, got shape %s" % (path, frames.shape))
+        self.frames = frames
+
+    @property
+    def shape(self):
+        return self.frames.shape
+
+    @property
+    def dtype(self):
+        return self.frames.dtype
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __getitem__(self, index):
+        """Frame (2D view) or stack (3D view, for a slice) at index"""
+        return self.frames[index]
+
+    def __iter__(self):
+        return iter(self.frames)
+
+
+def is_stack(path):
+    """True for the files FrameStack reads: .npy files and raw files with a sidecar"""
+    lower = path.lower()
+    if lower.endswith(".npy"):
+        return True
+    return not lower.endswith(".json") and os.path.isfile(sidecar_path(path))
+
+
+def write_stack(path, frames, raw=None):
+    """Save frames ((frames, height, width) array, or a sequence of 2D
+    arrays) as a stack FrameStack can map: a .npy file, or a raw file and its
+    sidecar (raw by default unless path ends with .npy)"""
+    frames = numpy.asarray(frames)
+    if raw is None:
+        raw = not path.lower().endswith(".npy")
+    if not raw:
+        numpy.save(path, frames)
+        return
+    frames.tofile(path)
+    with open(sidecar_path(path), "w") as f:
+        json.dump({"shape": list(frames.shape), "dtype": frames.dtype.str, "offset": 0}, f)
@@ -0,0 +1,106 @@
+# coding utf8
+# Per stage timings and counters of the detection functions
+
+
+import json
+import threading
+import time
+
+#Callables receiving each record, instrumentation is off while empty
+_sinks = []
+_local = threading.local()
+
+
+def add_sink(sink):
+    """Start sending the records to sink, a callable taking a record dict:
+
+    {"name": measured function, "start": time.time() of the call,
+     "total": seconds, "stages": {stage: seconds},
+     "counters": {counter: value}}
+
+    Instrumentation is on as long as a sink is registered."""
+    _sinks.append(sink)
+
+
+def remove_sink(sink):
+    _sinks.remove(sink)
+
+
+def active():
+    """True when a call is being measured in this thread"""
+    return bool(_sinks) and getattr(_local, "record", None) is not None
+
+
+class JsonLinesSink(object):
+    """Sink appending each record as a JSON line to a file
+
+    :param target: file name, or file object
+    """
+    def __init__(self, target):
+        self._lock = threading.Lock()
+        if isinstance(target, basestring):
+            self.file = open(target, "a")
+        else:
+            self.file = target
+
+    def __call__(self, record):
+        line = json.dumps(record, sort_keys=True)
+        with self._lock:
+            self.file.write(line + "\n")
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def measured(name):
+    """Decorator recording a call of the function as one record
+
+    Calls made while another measured call is running in the same thread
+    (e.g. find_loop on a window, or from find_loop_mesh) add to the record
+    of the outermost call."""
+    def decorator(function):
+        def wrapper(*args, **kwargs):
+            if not _sinks:
+                return function(*args, **kwargs)
+            record = getattr(_local, "record", None)
+            if record is not None:
+                return function(*args, **kwargs)
+            now = time.time()
+            record = _local.record = {"name": name, "start": now, "stages": {}, "counters": {}}
+            _local.last = now
+            try:
+                return function(*args, **kwargs)
+            finally:
+                _local.record = None
+                record["total"] = time.time() - now
+                for sink in list(_sinks):
+                    sink(record)
+        wrapper.__name__ = function.__name__
+        wrapper.__doc__ = function.__doc__
+        return wrapper
+    return decorator
+
+
+def lap(stage):
+    """Add the time since the previous lap (or the start of the call) to stage"""
+    if not _sinks:
+        return
+    record = getattr(_local, "record", None)
+    if record is None:
+        return
+    now = time.time()
+    stages = record["stages"]
+    stages[stage] = stages.get(stage, 0.0) + now - _local.last
+    _local.last = now
+
+
+def count(counter, n=1):
+    """Add n to counter"""
+    if not _sinks:
+        return
+    record = getattr(_local, "record", None)
+    if record is None:
+        return
+    counters = record["counters"]
+    counters[counter] = counters.get(counter, 0) + n
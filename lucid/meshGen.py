@@ -7,23 +7,36 @@ __contact__ = "etienne.francois@esrf.fr"
 __copyright__ = "2013, ESRF"
 
 
-import opencv
-import cv
 import math
-from toolbox import dilate,white_detect,displayCv,imgInfo2cvImage,toRadians
+from myutils import lazy_import,downsample
+from toolbox import dilate,white_detect,displayCv,imgInfo2cvImage,imgInfo2array,toRadians,IntegralImage
 import numpy as np
+import scipy.ndimage
+import instrument
+
+#Loaded on first use
+cv = lazy_import("cv")
 
 LUCID_CENTER_PROC = 0
 LUCID_RECT_BBOX = 1
 LUCID_POLY_BBOX = 2
 
+#Pyramid mode : downsampling factor of the coarse detection foreach zoom level
+#(zoom levels not listed are processed at full resolution only)
+LUCID_PYRAMID_SCALES = {}
+
+#Image processing backends
+LUCID_BACKEND_OPENCV = 0
+LUCID_BACKEND_NUMPY = 1
+
 #Not available yet
 #LUCID_ENTIRE_MESHING =3
 
 
 
 #Detection of loops in image
-def generate_meshing_info(imgInfo,method = LUCID_RECT_BBOX,showVisuals=False,zoom=0,virtCenter=None):
+@instrument.measured("generate_meshing_info")
+def generate_meshing_info(imgInfo,method = LUCID_RECT_BBOX,showVisuals=False,zoom=0,virtCenter=None,minAngleStep=None,maxRays=None,backend=LUCID_BACKEND_OPENCV,roi=None,scale=None,blockSize=None,shape=None,bufferDtype=np.uint8):
 
     """|
     
@@ -37,43 +50,186 @@ def generate_meshing_info(imgInfo,method = LUCID_RECT_BBOX,showVisuals=False,zoo
     :type zoom: uint
     :param virtCenter: A virtual center if reqal center use is not wanted
     :type virtCenter: Tuple (uint,uint)
+    :param minAngleStep: Finest angle step in degrees for the adaptive ray fan (15 degrees halved until not greater than this), None for the fixed 15 degrees fan
+    :type minAngleStep: float
+    :param maxRays: Maximum number of rays cast per frame by the adaptive ray fan
+    :type maxRays: uint
+    :param backend: Image processing backend, images returned for LUCID_CENTER_PROC are Numpy arrays with LUCID_BACKEND_NUMPY
+    :type backend: LUCID_BACKEND_OPENCV (legacy cv binding), LUCID_BACKEND_NUMPY (Numpy/Scipy only)
+    :param roi: Only process this window of the image, (-1,-1) virtCenter being then the center of the window. Returned coordinates are full frame pixels, returned images are the ones of the window.
+    :type roi: Tuple (x0,y0,x1,y1)
+    :param scale: Pyramid mode when > 1 and no roi is given : the loop is first found on the image downsampled by scale, then only the window around it is processed at full resolution (the whole image if the coarse level fails, see pyramidWindow). By default LUCID_PYRAMID_SCALES[zoom], or 1
+    :type scale: uint
+    :param blockSize: Size of the neighbourhood of the adaptive threshold, 21+50*zoom by default
+    :type blockSize: uint
+    :param shape: When given, imgInfo is a frame buffer (any object exporting the buffer protocol) of this shape, used without copy with LUCID_BACKEND_NUMPY (see toolbox.buffer2array)
+    :type shape: Tuple (uint,uint)
+    :param bufferDtype: Pixel type of a buffer imgInfo
+    :type bufferDtype: Numpy dtype
 
     :returns: (label,x,y) result from loop_detection function
 
     """
-   
-    image=imgInfo2cvImage(imgInfo)
-
-    image2=cv.CloneImage(image)
-    image3=cv.CloneImage(image)
-    cv.Zero(image3)
-
-    #image treatment
-    dilate(image,image,2)
-    cv.AdaptiveThreshold(image,image2,255,cv.CV_ADAPTIVE_THRESH_MEAN_C,cv.CV_THRESH_BINARY_INV,21+50*zoom,2)   
-    storage = cv.CreateMemStorage()
-    contours = cv.FindContours(cv.CloneImage(image2),storage,cv.CV_RETR_EXTERNAL,cv.CV_CHAIN_APPROX_SIMPLE,(0,0))
-    contours=cv.ApproxPoly(contours,storage,cv.CV_POLY_APPROX_DP,3,True);
-    cv.DrawContours(image3,contours,cv.RGB(255,255,255),cv.RGB (255,255,255),2)
+
+    if shape is not None:
+        imgInfo = imgInfo2array(imgInfo,shape,bufferDtype)
+    if blockSize is None:
+        blockSize = 21+50*zoom
+    if scale is None:
+        scale = LUCID_PYRAMID_SCALES.get(zoom,1)
+    if roi is None and scale > 1:
+        roi = pyramidWindow(imgInfo,scale,blockSize,virtCenter,backend)
+
+    if roi is not None:
+        instrument.lap("roi")
+        x0,y0,x1,y1 = roi
+        window = np.ascontiguousarray(imgInfo2array(imgInfo)[y0:y1,x0:x1])
+        if virtCenter is not None and virtCenter != (-1,-1):
+            virtCenter = (virtCenter[0]-x0,virtCenter[1]-y0)
+        result = generate_meshing_info(window,method,showVisuals,zoom,virtCenter,minAngleStep,maxRays,backend,blockSize=blockSize,scale=1)
+        return shiftMeshingInfo(method,showVisuals,result,x0,y0)
+
+    if backend == LUCID_BACKEND_NUMPY:
+        image,image3 = contourImage(imgInfo2array(imgInfo),blockSize,2)
+    else:
+        image=imgInfo2cvImage(imgInfo)
+
+        image2=cv.CloneImage(image)
+        image3=cv.CloneImage(image)
+        cv.Zero(image3)
+
+        #image treatment
+        dilate(image,image,2)
+        cv.AdaptiveThreshold(image,image2,255,cv.CV_ADAPTIVE_THRESH_MEAN_C,cv.CV_THRESH_BINARY_INV,blockSize,2)   
+        storage = cv.CreateMemStorage()
+        contours = cv.FindContours(cv.CloneImage(image2),storage,cv.CV_RETR_EXTERNAL,cv.CV_CHAIN_APPROX_SIMPLE,(0,0))
+        contours=cv.ApproxPoly(contours,storage,cv.CV_POLY_APPROX_DP,3,True);
+        cv.DrawContours(image3,contours,cv.RGB(255,255,255),cv.RGB (255,255,255),2)
+    #Contour lookups for the rays
+    integral = IntegralImage(image2array(image3))
+    instrument.lap("contour")
     #Virtual center treatment
-    virtCenter = virtualCenterTreatment(image3,virtCenter)
+    virtCenter = virtualCenterTreatment(integral,virtCenter)
     #Rays treatment
-    store,storeInfo = findInternalPoints(image3,image,4,virtCenter)
+    store,storeInfo = findInternalPoints(image3,image,4,virtCenter,integral,minAngleStep=minAngleStep,maxRays=maxRays)
+    instrument.lap("ray casting")
     #Adapt rays
-    ellipsecoord = fitLoop(store,storeInfo,image,virtCenter)
-    imageClone = cv.CloneImage(image)
+    ellipsecoord = fitLoop(store,storeInfo,integral,virtCenter)
+    instrument.lap("fitLoop")
+    center = (integral.width//2,integral.height//2)
     #Choose type of box for meshing
     if method==LUCID_CENTER_PROC:
         if showVisuals:
-            return getBoundingBox(method,store,storeInfo,(image.width//2,image.height//2)),imageClone,image3,store,virtCenter
+            imageClone = image.copy() if backend == LUCID_BACKEND_NUMPY else cv.CloneImage(image)
+            return getBoundingBox(method,store,storeInfo,center),imageClone,image3,store,virtCenter
         else:
-            return getBoundingBox(method,store,storeInfo,(image.width//2,image.height//2)),image3
+            return getBoundingBox(method,store,storeInfo,center),image3
+    else:
+        return getBoundingBox(method,store,storeInfo,center)
+    #polys = getPolygonBoundingBox(store,storeInfo,center)
+
+#Coarse level of the pyramid mode
+def pyramidWindow(imgInfo,scale,blockSize,virtCenter=None,backend=LUCID_BACKEND_OPENCV,margin=10):
+
+    """|
+
+    Bounding box of the loop found on the image downsampled by scale (with the
+    adaptive threshold block size reduced accordingly), in full resolution
+    pixels and enlarged by margin pixels. The coarse result is not trusted
+    when the first ray found no contour, when a ray missed (a (-1,-1) point,
+    which puts the box out of the frame) or when the box reaches the frame
+    edge : None is returned then, and the whole frame is processed.
+
+    :param imgInfo: Information about the input image
+    :type imgInfo: String or Numpy array
+    :param scale: Downsampling factor
+    :type scale: uint
+    :param blockSize: Size of the neighbourhood of the adaptive threshold at full resolution
+    :type blockSize: uint
+    :param virtCenter: Virtual center at full resolution
+    :type virtCenter: Tuple (uint,uint)
+    :param backend: Image processing backend
+    :param margin: Margin around the bounding box in full resolution pixels
+    :type margin: uint
+
+    :returns: Window (x0,y0,x1,y1), or None
+    """
+
+    image = imgInfo2array(imgInfo)
+    small = np.ascontiguousarray(downsample(image,scale),dtype=np.uint8)
+    #Odd block size, at least 3
+    smallBlock = max(blockSize//scale,3)|1
+    if virtCenter is None or virtCenter == (-1,-1):
+        virtCenter = (-1,-1)
     else:
+        virtCenter = (virtCenter[0]//scale,virtCenter[1]//scale)
+    try:
+        x,y,x2,y2 = generate_meshing_info(small,LUCID_RECT_BBOX,virtCenter=virtCenter,backend=backend,scale=1,blockSize=smallBlock)
+    except IndexError:
+        #No contour straight above the center
+        return None
+    if x<=0 or y<=0 or x2>=small.shape[1]-1 or y2>=small.shape[0]-1:
+        return None
+    height,width = image.shape[:2]
+    return (max(x*scale-margin,0),max(y*scale-margin,0),min((x2+1)*scale+margin,width),min((y2+1)*scale+margin,height))
+
+#Move the coordinates returned by generate_meshing_info from a window to the full frame
+def shiftMeshingInfo(method,showVisuals,result,x0,y0):
+
+    """|
+
+    :param method: Method use in generate_meshing_info
+    :param showVisuals: showVisuals option of generate_meshing_info
+    :param result: Return of generate_meshing_info on the window
+    :param x0: Left of the window
+    :param y0: Top of the window
+
+    :returns: result in full frame coordinates
+    """
+
+    def shiftBox(box):
+        return box[0]+x0,box[1]+y0,box[2]+x0,box[3]+y0
+    def shiftPoints(points):
+        return [(x+x0,y+y0) for (x,y) in points]
+
+    if method==LUCID_CENTER_PROC:
         if showVisuals:
-            return getBoundingBox(method,store,storeInfo,(image.width//2,image.height//2))
-        else:
-            return getBoundingBox(method,store,storeInfo,(image.width//2,image.height//2))
-    #polys = getPolygonBoundingBox(store,storeInfo,(image.width//2,image.height//2))
+            box,imageClone,image3,store,virtCenter = result
+            return shiftBox(box),imageClone,image3,shiftPoints(store),(virtCenter[0]+x0,virtCenter[1]+y0)
+        return (shiftBox(result[0]),)+tuple(result[1:])
+    elif method==LUCID_POLY_BBOX:
+        return shiftPoints(result)
+    return shiftBox(result)
+
+#Numpy version of the dilatation, adaptive threshold and external contours drawing
+def contourImage(image,blockSize,offset):
+
+    """|
+
+    Same treatment as the OpenCV backend of generate_meshing_info without leaving
+    Numpy : grey dilatation (two 3x3 passes), mean adaptive threshold (inverted
+    binary), then the outer boundary of each region, drawn 2 pixels wide. The
+    contours are not approximated by polygons.
+
+    :param image: Input image
+    :type image: Numpy array
+    :param blockSize: Size of the neighbourhood of the adaptive threshold
+    :type blockSize: uint
+    :param offset: Constant subtracted from the neighbourhood mean
+    :type offset: float
+
+    :returns: Dilated image, contour image (0/255 uint8)
+    """
+
+    dilated = scipy.ndimage.maximum_filter(image,size=5)
+    #Converted to float while filtering
+    mean = scipy.ndimage.uniform_filter(dilated,blockSize,output=np.float32,mode='nearest')
+    binary = dilated <= (mean-offset)
+    #External contours : boundary of the regions with their holes filled
+    filled = scipy.ndimage.binary_fill_holes(binary)
+    contour = filled & ~scipy.ndimage.binary_erosion(filled,structure=np.ones((3,3),bool))
+    contour = scipy.ndimage.binary_dilation(contour,structure=np.ones((2,2),bool))
+    return dilated,contour.astype(np.uint8)*255
 
 
 #A little very simple treatment of the virtual center
@@ -81,8 +237,8 @@ def virtualCenterTreatment(image,virtCenter):
 
     """|
     
-    :param image: Image treated
-    :type image: Opencv IplImage
+    :param image: Image treated, only its size is used
+    :type image: Opencv IplImage or IntegralImage
     :param virtCenter: A virtual center if reqal center use is not wanted
     :type virtCenter: Tuple (uint,uint)
 
@@ -146,158 +302,266 @@ def getBoundingBox(method,storage,storageInfo,center):
         return polyList
 
 #Find inetrnal points of the loop with arc launching method
-def findInternalPoints(image,image2,pointsPerArcs,center=(-1,-1)):
+def findInternalPoints(image,image2,pointsPerArcs,center=(-1,-1),integral=None,angleStep=15,minAngleStep=None,maxRays=None):
     
     """|
     
     :param image: Image after first treatment
-    :type image: Opencv IplImage
+    :type image: Opencv IplImage or Numpy array
     :param image2: Initial image treated
     :type image2: Opencv IplImage
-    :param storage: Internal points of the loop
-    :type storage: Array[(uint,uint)...(uint,uint)]
-    :param storageInfo: Values of constant of line equation foreach internal points. a and b for an equation ax+b.
-    :type storageInfo: Array[(float,float)...(float,float)].
     :param center: Coordinate of the center of the image
     :type center: Tuple (uint,uint)
-
-    :returns: With method LUCID_CENTER_PROC and LUCID_RECT_BBOX, return coordinates for a rectangle bounding box (xmin,ymin,xmax,ymax)
-    :returns: With method LUCID_POLY_BBOX, return all points of the polygone
+    :param integral: Integral image of image, computed if not given
+    :type integral: IntegralImage
+    :param angleStep: Angle step of the (coarse) ray fan in degrees
+    :type angleStep: float
+    :param minAngleStep: If set, the sectors around outlier rays are halved until the angle step is not greater than this
+    :type minAngleStep: float
+    :param maxRays: Maximum number of rays cast, including the first one (no limit if None), the coarse fan is always cast
+    :type maxRays: uint
+
+    :returns: storage, internal points of the loop : Array[(uint,uint)...(uint,uint)]
+    :returns: storageInfo, values of constant of line equation foreach internal points. a and b for an equation ax+b : Array[(float,float)...(float,float)]
 
     """
-    
+
+    if integral is None:
+        integral = IntegralImage(image2array(image))
     #init list for points (storage) and for curve equation information
     storage = []
     storageInfo = []
     if center == (-1,-1):
-        center = (image.width//2+50,image.height//2)
-    i = center[1]
-    while i>=0:
-        if image[i,center[0]]>0:
-            storage.append((center[0],i))
-            storageInfo.append((0,1))
-            break;
-	else:
-            i=i-1
-    #print storage[0][0]
-    for degrees in np.arange(15,360,15):
-    #for degrees in np.arange(5,360,5):
-	    x2 = storage[0][0]-center[0]
-	    y2 = storage[0][1]-center[1]
-
-	    xrot = x2*math.cos(toRadians(degrees))-y2*math.sin(toRadians(degrees))
-	    yrot = y2*math.cos(toRadians(degrees))+x2*math.sin(toRadians(degrees))
-
-	    xrot = round(xrot + center[0])
-	    yrot = round(yrot + center[1])
-            #cv.Line( image2, (image.width//2,image.height//2), (xrot,yrot),cv.Scalar( 60, 60,60 ),2,4 );
-	    #print "inter"
-            if center[0]==xrot:
-	            m=1
-	            p=0
-                    i = center[1]
-		    while i<image.height:
-			if image[i,center[0]]>0:
-			    storage.append((center[0],i))
-                            storageInfo.append((m,p))
-			    break;
-			else:
-			    i=i+1
-                        if i==image.height:
-                            storage.append((-1,-1))
-            else:
-		    m = (yrot - center[1])/(xrot - center[0])
-		    p = -(m*xrot)+yrot
-		    #print center[0],center[1],xrot,yrot,m,p
-		    x = center[0]
-		    y = center[1]
-		    ok =False
-
-		    while 1:
-                        if degrees<190:
-			    x=x+1
-                        else:
-                            x=x-1
-			y=m*x+p
-			y = int(round(y))
-			if x<image.width-2 and x>=2 and y<image.height-2 and y>=2:
-			    if white_detect(image[(y-2):(y+2),(x-2):(x+2)])>0:
-				storage.append((x,y))
-                                storageInfo.append((m,p))
-				ok = True
-				#cv.Circle( image,storage[0],5,cv.RGB(255,255,255 ),-1,8 )
-				break
-			else:
-			    break
-		    if ok == False:
-			    x = center[0]
-			    y = center[1]
-			    while 1:
-		                if degrees<90 or degrees>270:
-				    y=y-1
-		                else:
-		                    y=y+1
-                                if m==0:
-                                   #storage.append((0,0))
-                                   break
-				x=(y-p)/m
-				x = int(round(x))
-				if x<image.width-2 and x>=2 and y<image.height-2 and y>=2:
-				    if white_detect(image[(y-2):(y+2),(x-2):(x+2)])>0:
-					storage.append((x,y))
-                                        storageInfo.append((m,p))
-					#cv.Circle( image,storage[0],5,cv.RGB(255,255,255 ),-1,8 )
-					break
-				else:
-				    #storage.append((0,0))
-				    break
+        center = (integral.width//2+50,integral.height//2)
+
+    #First point straight above the center
+    rows = np.arange(center[1],-1,-1)
+    column = np.flatnonzero(integral.white_detect_many(rows,rows+1,center[0],center[0]+1))
+    if len(column):
+        storage.append((center[0],int(rows[column[0]])))
+        storageInfo.append((0,1))
+
+    angles = np.arange(angleStep,360,angleStep)
+    fan = dict(zip(angles,castRays(integral,center,storage[0],angles)))
+
+    if minAngleStep is not None:
+        refineFan(fan,integral,center,storage[0],angleStep,minAngleStep,maxRays)
+
+    for degrees in sorted(fan):
+        point,info = fan[degrees]
+        if point is not None:
+            storage.append(point)
+            if info is not None:
+                storageInfo.append(info)
     return storage,storageInfo
 
+#Coarse to fine angular resolution of the ray fan
+def refineFan(fan,integral,center,start,angleStep,minAngleStep,maxRays=None):
+
+    """|
+
+    Halve the angle step around the rays flagged as outliers (distance to the
+    center greater or equal to average + standard deviation, as in fitLoop)
+    until it is not greater than minAngleStep, or the ray budget is reached.
+    The steps are angleStep/2**k, so the finest one can be below minAngleStep
+    (3.75 degrees for 5 with a 15 degrees fan). New rays are added to fan.
+
+    :param fan: Rays already cast, {angle : (point,(m,p))} as returned by castRays
+    :type fan: Dictionary
+    :param integral: Integral image of the image after first treatment
+    :type integral: IntegralImage
+    :param center: Coordinate of the center
+    :type center: Tuple (uint,uint)
+    :param start: Point of reference of the rays (angle 0)
+    :type start: Tuple (uint,uint)
+    :param angleStep: Angle step of the coarse fan
+    :type angleStep: float
+    :param minAngleStep: Largest accepted finest angle step
+    :type minAngleStep: float
+    :param maxRays: Maximum number of rays cast, including the first one (no limit if None)
+    :type maxRays: uint
+    """
+
+    step = float(angleStep)
+    while step > minAngleStep:
+        step = step/2
+        budget = None if maxRays is None else maxRays-1-len(fan)
+        if budget is not None and budget <= 0:
+            break
+        angles = [degrees for degrees in sorted(fan) if fan[degrees][0] not in (None,(-1,-1))]
+        if len(angles) < 2:
+            break
+        points = np.array([fan[degrees][0] for degrees in angles]+[start],dtype=float)
+        lengths = np.hypot(points[:,0]-center[0],points[:,1]-center[1])
+        limit = lengths.mean()+lengths.std(ddof=1)
+        flagged = np.flatnonzero(lengths[:-1]>=limit)
+        #Largest jumps first when the budget is short
+        flagged = flagged[np.argsort(-lengths[flagged],kind='mergesort')]
+        newAngles = []
+        for num in flagged:
+            for degrees in (angles[num]-step,angles[num]+step):
+                if 0 < degrees < 360 and degrees not in fan and degrees not in newAngles:
+                    newAngles.append(degrees)
+        if budget is not None:
+            newAngles = newAngles[:budget]
+        if not newAngles:
+            break
+        fan.update(zip(newAngles,castRays(integral,center,start,newAngles)))
+    return fan
+
+def castRays(integral,center,start,angles):
+
+    """|
+
+    Launch all the rays of a fan at once. A ray goes from the center toward
+    the point start rotated by the angle, one pixel step at a time along x
+    (or along y if x stepping found nothing), and stops on the first probe
+    window containing contour pixels.
+
+    :param integral: Integral image of the image after first treatment
+    :type integral: IntegralImage
+    :param center: Coordinate of the center
+    :type center: Tuple (uint,uint)
+    :param start: Point of reference of the rays (angle 0)
+    :type start: Tuple (uint,uint)
+    :param angles: Angles of the rays in degrees
+    :type angles: Iterable of numbers
+
+    :returns: List of (point,(m,p)) foreach angle, point is None when the ray found nothing
+
+    """
+
+    instrument.count("rays",len(angles))
+    height,width = integral.height,integral.width
+    x2 = start[0]-center[0]
+    y2 = start[1]-center[1]
+    results = [None]*len(angles)
+    slanted = []
+    for num,degrees in enumerate(angles):
+        xrot = x2*math.cos(toRadians(degrees))-y2*math.sin(toRadians(degrees))
+        yrot = y2*math.cos(toRadians(degrees))+x2*math.sin(toRadians(degrees))
+        xrot = round(xrot + center[0])
+        yrot = round(yrot + center[1])
+        if center[0]==xrot:
+            #Vertical ray, pixels are tested one by one downward
+            rows = np.arange(center[1],height)
+            instrument.count("pixels probed",len(rows))
+            column = np.flatnonzero(integral.white_detect_many(rows,rows+1,center[0],center[0]+1))
+            if len(column):
+                results[num] = ((center[0],int(rows[column[0]])),(1,0))
+            else:
+                results[num] = ((-1,-1),None)
+        else:
+            m = (yrot - center[1])/(xrot - center[0])
+            p = -(m*xrot)+yrot
+            #Step directions toward the rotated point
+            slanted.append((num,1 if xrot>center[0] else -1,-1 if yrot<center[1] else 1,m,p))
+            results[num] = (None,(m,p))
+    if not slanted:
+        return results
+
+    nums = np.array([s[0] for s in slanted])
+    dx = np.array([s[1] for s in slanted])[:,np.newaxis]
+    dy = np.array([s[2] for s in slanted])[:,np.newaxis]
+    m = np.array([s[3] for s in slanted],dtype=float)[:,np.newaxis]
+    p = np.array([s[4] for s in slanted],dtype=float)[:,np.newaxis]
+
+    #Step along x
+    steps = np.arange(1,width+1)
+    xs = center[0]+dx*steps
+    ys = roundHalfAway(m*xs+p)
+    xs,ys,found = firstHits(integral,xs,ys)
+
+    #Step along y for the rays which found nothing
+    missing = ~found & (m[:,0]!=0)
+    if missing.any():
+        steps = np.arange(1,height+1)
+        ys2 = center[1]+dy[missing]*steps
+        xs2 = roundHalfAway((ys2-p[missing])/m[missing])
+        xs[missing],ys[missing],found[missing] = firstHits(integral,xs2,ys2)
+
+    for num,x,y,ok in zip(nums,xs,ys,found):
+        if ok:
+            results[num] = ((int(x),int(y)),results[num][1])
+    return results
+
+def firstHits(integral,xs,ys):
+
+    """|
+
+    :param integral: Integral image of the image after first treatment
+    :type integral: IntegralImage
+    :param xs: x coordinates along each ray, one ray per row
+    :type xs: Numpy array
+    :param ys: y coordinates along each ray, one ray per row
+    :type ys: Numpy array
+
+    :returns: x, y of the first hit of each ray before it leaves the image, and whether there is one
+
+    """
+
+    height,width = integral.height,integral.width
+    inside = (xs<width-2)&(xs>=2)&(ys<height-2)&(ys>=2)
+    #A ray stops at its first step outside of the image
+    inside = np.logical_and.accumulate(inside,axis=1)
+    if instrument.active():
+        instrument.count("pixels probed",int(inside.sum()))
+    #Probe windows image[(y-2):(y+2),(x-2):(x+2)]
+    hit = inside & (integral.white_detect_many(ys-2,ys+2,xs-2,xs+2)>0)
+    first = np.argmax(hit,axis=1)
+    rows = np.arange(len(first))
+    return xs[rows,first],ys[rows,first],hit[rows,first]
+
+def roundHalfAway(values):
+    """Python 2 round() (half away from zero) on arrays, as integers"""
+    return np.where(values>=0,np.floor(values+0.5),np.ceil(values-0.5)).astype(int)
+
+def image2array(image):
+    """|
+
+    :param image: Image
+    :type image: Opencv IplImage or Numpy array
+
+    :returns: Numpy view on the image data
+    """
+    if isinstance(image,np.ndarray):
+        return image
+    return np.asarray(cv.GetMat(image))
+
 def fitLoop(storage,storageInfo,image,virtCenter):
 
-    center = virtCenter
-    res = 0
-    
-    #Average of the distance to the center
-    for num in range(len(storage)):
-        ptb = storage[num]
-        res += math.sqrt(((ptb[0]-center[0])*(ptb[0]-center[0]))+((ptb[1]-center[1])*(ptb[1]-center[1])))
+    """|
 
-    res = res/len(storage)
-    stDev = 0
-    
-    #Calculating the standard deviation (in French : Ecart-type)
-    for num in range(len(storage)):
-        ptb = storage[num]
-        stDev += (math.sqrt(((ptb[0]-center[0])*(ptb[0]-center[0]))+((ptb[1]-center[1])*(ptb[1]-center[1]))) - res)*(math.sqrt(((ptb[0]-center[0])*(ptb[0]-center[0]))+((ptb[1]-center[1])*(ptb[1]-center[1]))) - res)
+    Detect the rays much longer than the others (distance to the center greater
+    or equal to average + standard deviation) and bring the inconsistent ones
+    back to the length of their neighbours. All rays are checked against the
+    lengths before correction, in one pass.
 
-    stDev = stDev/(len(storage)-1)
-    stDev = math.sqrt(stDev)
+    :param storage: Internal points of the loop, corrected in place
+    :type storage: Array[(uint,uint)...(uint,uint)]
+    :param storageInfo: Values of constant of line equation foreach internal points. a and b for an equation ax+b.
+    :type storageInfo: Array[(float,float)...(float,float)].
+    :param image: Image treated, only its size is used
+    :type image: Opencv IplImage or IntegralImage
+    :param virtCenter: Center of the rays
+    :type virtCenter: Tuple (uint,uint)
 
-    #print "moyenne"
-    #print res
-    #print "ecart type"
-    #print stDev
-    #print "somme"
-    #print stDev+res
+    :returns: The corrected storage
+    """
+
+    if len(storage) < 2:
+        return storage
+    lengths = rayLengths(storage,virtCenter)
 
     #Define a limit : Average + Standard Deviation
-    limit = res+stDev
+    limit = lengths.mean()+lengths.std(ddof=1)
 
-    #Define a list of rays with a distance to the center greater or equals than the limit
-    warningList = []
-    for num in range(len(storage)):
-        ptb = storage[num]
-        res = math.sqrt(((ptb[0]-center[0])*(ptb[0]-center[0]))+((ptb[1]-center[1])*(ptb[1]-center[1])))
-        if res >= limit:
-             warningList.append(num)
-    warningList.sort()
+    #Rays with a distance to the center greater or equals than the limit
+    warning = lengths>=limit
 
     #Check if rays detected are really non consistant
-    while len(warningList) >= 1:
-        boolR = checkConsistancy(image,storage,storageInfo,warningList,center,warningList[0],'r')
-        del(warningList[warningList.index(warningList[0])])    
-    #print 'achtungicht',list(set(warningList))
+    storage[:],needed = correctRays(image,storage,storageInfo,virtCenter,lengths,warning,warning)
+    return storage
     '''
     PointArray = cv.CreateMat(1,len(storage),cv.CV_32FC2)
     for num in range(len(storage)):
@@ -305,79 +569,97 @@ def fitLoop(storage,storageInfo,image,virtCenter):
     return cv.FitEllipse2(PointArray)
     '''
 
+#image can be the IplImage or its IntegralImage, only its size is used
 def checkConsistancy(image,storage,storageInfo,warningList,center,iden,side):
-    #print warningList,iden
-    i = 0
-
-    #Calcultate distance to center
-    ptb = storage[iden]
-    res = math.sqrt(((ptb[0]-center[0])*(ptb[0]-center[0]))+((ptb[1]-center[1])*(ptb[1]-center[1])))
-    ptb = storage[(iden - 1)%len(storage)]
-    res2 = math.sqrt(((ptb[0]-center[0])*(ptb[0]-center[0]))+((ptb[1]-center[1])*(ptb[1]-center[1])))
-    ptb = storage[(iden + 1)%len(storage)]
-    res3 = math.sqrt(((ptb[0]-center[0])*(ptb[0]-center[0]))+((ptb[1]-center[1])*(ptb[1]-center[1])))
-
-    #Compare to know if a modification is needed
-    if res>res2+(0.6*res2) or res>res3+(0.6*res3):
-        ptb = storage[iden]
-        m = storageInfo[iden][0]
-        p = storageInfo[iden][1]
-           
-        #Find a reference after the studied point
-        indexL = (iden + 1)%len(storage)
-        ecartL = 1
-        lengthPropL=0
-
-        while 1:
-             #Check if the first ref after is or is not in the list of warning rays, if not pass the the next loop's iteration
-             if (indexL in warningList):
-                 indexL = (indexL + 1)%len(storage)
-                 ecartL += 1
-             #Check if the ref after the first ref is not in list and define a length with these two ref
-             elif (indexL + 1)%len(storage) not in warningList:
-                 #Explain TODO
-                 lengthPropL = math.sqrt(((storage[indexL][0]-center[0])*(storage[indexL][0]-center[0]))+((storage[indexL][1]-center[1])*(storage[indexL][1]-center[1]))) + abs((math.sqrt(((storage[indexL][0]-center[0])*(storage[indexL][0]-center[0]))+((storage[indexL][1]-center[1])*(storage[indexL][1]-center[1]))))-(math.sqrt(((storage[(indexL + 1)%len(storage)][0]-center[0])*(storage[(indexL + 1)%len(storage)][0]-center[0]))+((storage[(indexL + 1)%len(storage)][1]-center[1])*(storage[(indexL + 1)%len(storage)][1]-center[1])))))
-                 break
-             #if the first ref is ok but not the second one, define a length based only on the first one
-             else:
-                 lengthPropL = math.sqrt(((storage[indexL][0]-center[0])*(storage[indexL][0]-center[0]))+((storage[indexL][1]-center[1])*(storage[indexL][1]-center[1])))
-                 break
-
-        #Explanation identical to the precedent one
-        indexR =(iden - 1)%len(storage)
-        ecartR = 1
-        lengthPropR=0
-        while 1:
-            if (indexR in warningList):
-                 indexR = (indexR - 1)%len(storage)
-                 ecartR += 1
-            elif (indexR - 1)%len(storage) not in warningList:
-                 lengthPropL = math.sqrt(((storage[indexR][0]-center[0])*(storage[indexR][0]-center[0]))+((storage[indexR][1]-center[1])*(storage[indexR][1]-center[1]))) + abs((math.sqrt(((storage[indexR][0]-center[0])*(storage[indexR][0]-center[0]))+((storage[indexR][1]-center[1])*(storage[indexR][1]-center[1]))))-(math.sqrt(((storage[(indexR-1)%len(storage)][0]-center[0])*(storage[(indexR-1)%len(storage)][0]-center[0]))+((storage[(indexR-1)%len(storage)][1]-center[1])*(storage[(indexR-1)%len(storage)][1]-center[1])))))
-                 break
-            else:
-                 lengthPropR = math.sqrt(((storage[indexR][0]-center[0])*(storage[indexR][0]-center[0]))+((storage[indexR][1]-center[1])*(storage[indexR][1]-center[1])))
-                 break
+    warning = np.zeros(len(storage),dtype=bool)
+    warning[list(warningList)] = True
+    candidates = np.zeros(len(storage),dtype=bool)
+    candidates[iden] = True
+    storage[:],needed = correctRays(image,storage,storageInfo,center,rayLengths(storage,center),warning,candidates)
+    return bool(needed[iden])
+
+def rayLengths(storage,center):
+    """|
 
+    :returns: Numpy array of the distances of the points of storage to the center
+    """
+    points = np.asarray(storage,dtype=float).reshape(-1,2)
+    dx = points[:,0]-center[0]
+    dy = points[:,1]-center[1]
+    return np.sqrt(dx*dx+dy*dy)
 
-        #print (((ecartR*lengthPropL)+(ecartL*lengthPropR))/(ecartR+ecartL))             
-        x=center[0]
-        while 1:
-            if center[0]<ptb[0]:
-                x=x+1
-            else:
-                x=x-1
-	    y=m*x+p
-            y = int(round(y))
-	    if x<image.width-2 and x>0 and y<image.height-2 and y>0:
-                l = math.sqrt(((x-center[0])*(x-center[0]))+((y-center[1])*(y-center[1])))
-                    
-	        if l>=(((ecartR*lengthPropL)+(ecartL*lengthPropR))/(ecartR+ecartL)):
-	    	    #print l
-                    storage[iden] = (x,y)
-                    #print (x,y),storage
-                    break
-            else:
-		break
-        return True
-    else:
-        return False
+def correctRays(image,storage,storageInfo,center,lengths,warning,candidates):
+
+    """|
+
+    Vectorised consistency check of the rays. A candidate ray more than 60%
+    longer than one of its neighbours is moved along its line to the length
+    expected from the nearest non warning rays on each side, weighted by
+    their angular distance.
+
+    :param image: Image treated, only its size is used
+    :type image: Opencv IplImage or IntegralImage
+    :param storage: Internal points of the loop
+    :type storage: Array[(uint,uint)...(uint,uint)]
+    :param storageInfo: Values of constant of line equation foreach internal points
+    :type storageInfo: Array[(float,float)...(float,float)].
+    :param center: Center of the rays
+    :type center: Tuple (uint,uint)
+    :param lengths: Distances of the points to the center
+    :type lengths: Numpy array
+    :param warning: Rays not usable as references
+    :type warning: Numpy boolean array
+    :param candidates: Rays to check
+    :type candidates: Numpy boolean array
+
+    :returns: New list of points, and the boolean array of rays which needed a correction
+    """
+
+    n = len(storage)
+    storage = list(storage)
+    #Compare to the direct neighbours to know if a modification is needed
+    previous = np.roll(lengths,1)
+    following = np.roll(lengths,-1)
+    needed = candidates & ((lengths>previous+(0.6*previous)) | (lengths>following+(0.6*following)))
+    #storageInfo may miss the line equation of a ray which found nothing
+    needed[len(storageInfo):] = False
+    if warning.all() or not needed.any():
+        return storage,needed
+    idens = np.flatnonzero(needed)
+
+    #Nearest non warning rays after (L) and before (R) each ray, over two turns
+    index = np.arange(2*n)
+    valid = np.tile(~warning,2)
+    after = np.minimum.accumulate(np.where(valid,index,2*n)[::-1])[::-1]
+    before = np.maximum.accumulate(np.where(valid,index,-1))
+    indexL = after[idens+1]
+    ecartL = indexL-idens
+    indexL = indexL%n
+    indexR = before[idens+n-1]
+    ecartR = idens+n-indexR
+    indexR = indexR%n
+
+    #Reference length on each side, extrapolated with the next reference if it is usable
+    lengthPropL = lengths[indexL]+np.where(valid[(indexL+1)%n],abs(lengths[indexL]-lengths[(indexL+1)%n]),0)
+    lengthPropR = lengths[indexR]+np.where(valid[(indexR-1)%n],abs(lengths[indexR]-lengths[(indexR-1)%n]),0)
+    target = ((ecartR*lengthPropL)+(ecartL*lengthPropR))/(ecartR+ecartL).astype(float)
+
+    #Walk along each ray line up to the target length
+    info = np.array([storageInfo[iden] for iden in idens],dtype=float).reshape(-1,2)
+    m = info[:,0:1]
+    p = info[:,1:2]
+    points = np.array([storage[iden] for iden in idens]).reshape(-1,2)
+    direction = np.where(center[0]<points[:,0],1,-1)[:,np.newaxis]
+    xs = center[0]+direction*np.arange(1,image.width+1)
+    ys = roundHalfAway(m*xs+p)
+    inside = (xs<image.width-2)&(xs>0)&(ys<image.height-2)&(ys>0)
+    inside = np.logical_and.accumulate(inside,axis=1)
+    dx = xs-center[0]
+    dy = ys-center[1]
+    reached = inside & (np.sqrt(dx*dx+dy*dy)>=target[:,np.newaxis])
+    first = np.argmax(reached,axis=1)
+    rows = np.arange(len(idens))
+    for iden,x,y,ok in zip(idens,xs[rows,first],ys[rows,first],reached[rows,first]):
+        if ok:
+            storage[iden] = (int(x),int(y))
+    return storage,needed
@@ -1,16 +1,84 @@
 from math import ceil
+import sys
+import time
+import subprocess
 import numpy
-def expand(input_img, sigma, mode="constant", cval=0.0):
+
+#Heavy modules which "import lucid" alone should not load
+#(PIL is not listed: some scipy versions import it from scipy.ndimage)
+HEAVY_MODULES = ("pylab", "matplotlib", "cv", "opencv", "cv2", "mahotas", "scipy.stats", "Image")
+#Time budget of "import lucid" in a fresh interpreter, in seconds
+IMPORT_TIME_BUDGET = 1.0
+
+
+class LazyModule(object):
+    """Stand-in for a module, imported on first attribute access
+
+    Behaves like the result of "import name": for a dotted name the top
+    level package is returned, with the submodule loaded."""
+    def __init__(self, name):
+        self.__dict__["_name"] = name
+        self.__dict__["_module"] = None
+
+    def _load(self):
+        module = self.__dict__["_module"]
+        if module is None:
+            __import__(self._name)
+            module = sys.modules[self._name.split(".")[0]]
+            self.__dict__["_module"] = module
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __repr__(self):
+        return "<lazy module %r%s>" % (self._name, "" if self.__dict__["_module"] is None else " (loaded)")
+
+
+def lazy_import(name):
+    """Return a LazyModule for name, the import happens on first use"""
+    return LazyModule(name)
+
+
+def import_cost(module="lucid", heavy=HEAVY_MODULES):
+    """Measure the import of module in a fresh interpreter
+
+    @return: (seconds, list of the heavy modules loaded by the import)
+    """
+    code = ("import sys, time\n"
+            "t = time.time()\n"
+            "import %s\n"
+            "sys.stdout.write('%%r\\n' %% (time.time() - t))\n"
+            "sys.stdout.write(' '.join(m for m in %r if m in sys.modules))\n") % (module, tuple(heavy))
+    out = subprocess.check_output([sys.executable, "-c", code]).decode().split("\n")
+    return float(out[0]), out[1].split()
+
+
+def check_import_budget(module="lucid", budget=IMPORT_TIME_BUDGET):
+    """Raise RuntimeError if importing module is slower than budget or loads heavy modules"""
+    seconds, loaded = import_cost(module)
+    if seconds > budget or loaded:
+        raise RuntimeError("import %s: %.3fs (budget %.3fs), heavy modules loaded: %s" % (module, seconds, budget, ", ".join(loaded) or "none"))
+    return seconds
+
+
+def expand(input_img, sigma, mode="constant", cval=0.0, out=None, dtype=None):
 
     """Expand array a with its reflection on boundaries
 
-@param a: 2D array
+@param a: 2D array, or stack of 2D arrays (padding applies to the last two axes)
 @param sigma: float or 2-tuple of floats
 @param mode:"constant","nearest" or "reflect"
 @param cval: filling value used for constant, 0.0 by default
+@param out: array of the expanded shape to write the result into, allocated if None
+@param dtype: type of the allocated result (e.g. numpy.float32), the type of input_img by default
 """
-    s0, s1 = input_img.shape
-    dtype = input_img.dtype
+    s0, s1 = input_img.shape[-2:]
+    if dtype is None:
+        dtype = input_img.dtype
     if isinstance(sigma, (list, tuple)):
         k0 = int(ceil(float(sigma[0])))
         k1 = int(ceil(float(sigma[1])))
@@ -18,57 +86,139 @@ def expand(input_img, sigma, mode="constant", cval=0.0):
         k0 = k1 = int(ceil(float(sigma)))
     if k0 > s0 or k1 > s1:
         raise RuntimeError("Makes little sense to apply a kernel (%i,%i)larger than the image (%i,%i)" % (k0, k1, s0, s1))
-    output = numpy.zeros((s0 + 2 * k0, s1 + 2 * k1), dtype=dtype) + float(cval)
-    output[k0:k0 + s0, k1:k1 + s1] = input_img
+    shape = input_img.shape[:-2] + (s0 + 2 * k0, s1 + 2 * k1)
+    if out is None:
+        output = numpy.empty(shape, dtype=dtype)
+    elif out.shape != shape:
+        raise RuntimeError("Output array of shape %s, expected %s" % (out.shape, shape))
+    else:
+        output = out
+    if mode == "constant":
+        # the other modes fill all the borders
+        output.fill(cval)
+    output[..., k0:k0 + s0, k1:k1 + s1] = input_img
     if (mode == "mirror"):
-	# 4 corners
-	output[s0 + k0:, s1 + k1:] = input_img[-2:-k0 - 2:-1, -2:-k1 - 2:-1]
-	output[:k0, :k1] = input_img[k0 - 0:0:-1, k1 - 0:0:-1]
-	output[:k0, s1 + k1:] = input_img[k0 - 0:0:-1, s1 - 2: s1 - k1 - 2:-1]
-	output[s0 + k0:, :k1] = input_img[s0 - 2: s0 - k0 - 2:-1, k1 - 0:0:-1]
-	# 4 sides
-	output[k0:k0 + s0, :k1] = input_img[:s0, k1 - 0:0:-1]
-	output[:k0, k1:k1 + s1] = input_img[k0 - 0:0:-1, :s1]
-	output[-k0:, k1:s1 + k1] = input_img[-2:s0 - k0 - 2:-1, :]
-	output[k0:s0 + k0, -k1:] = input_img[:, -2:s1 - k1 - 2:-1]
+        # 4 corners
+        output[..., s0 + k0:, s1 + k1:] = input_img[..., -2:-k0 - 2:-1, -2:-k1 - 2:-1]
+        output[..., :k0, :k1] = input_img[..., k0 - 0:0:-1, k1 - 0:0:-1]
+        output[..., :k0, s1 + k1:] = input_img[..., k0 - 0:0:-1, s1 - 2: s1 - k1 - 2:-1]
+        output[..., s0 + k0:, :k1] = input_img[..., s0 - 2: s0 - k0 - 2:-1, k1 - 0:0:-1]
+        # 4 sides
+        output[..., k0:k0 + s0, :k1] = input_img[..., :s0, k1 - 0:0:-1]
+        output[..., :k0, k1:k1 + s1] = input_img[..., k0 - 0:0:-1, :s1]
+        output[..., -k0:, k1:s1 + k1] = input_img[..., -2:s0 - k0 - 2:-1, :]
+        output[..., k0:s0 + k0, -k1:] = input_img[..., :, -2:s1 - k1 - 2:-1]
     elif mode == "reflect":
     # 4 corners
-        output[s0 + k0:, s1 + k1:] = input_img[-1:-k0 - 1:-1, -1:-k1 - 1:-1]
-        output[:k0, :k1] = input_img[k0 - 1::-1, k1 - 1::-1]
-        output[:k0, s1 + k1:] = input_img[k0 - 1::-1, s1 - 1: s1 - k1 - 1:-1]
-        output[s0 + k0:, :k1] = input_img[s0 - 1: s0 - k0 - 1:-1, k1 - 1::-1]
+        output[..., s0 + k0:, s1 + k1:] = input_img[..., -1:-k0 - 1:-1, -1:-k1 - 1:-1]
+        output[..., :k0, :k1] = input_img[..., k0 - 1::-1, k1 - 1::-1]
+        output[..., :k0, s1 + k1:] = input_img[..., k0 - 1::-1, s1 - 1: s1 - k1 - 1:-1]
+        output[..., s0 + k0:, :k1] = input_img[..., s0 - 1: s0 - k0 - 1:-1, k1 - 1::-1]
     # 4 sides
-        output[k0:k0 + s0, :k1] = input_img[:s0, k1 - 1::-1]
-        output[:k0, k1:k1 + s1] = input_img[k0 - 1::-1, :s1]
-        output[-k0:, k1:s1 + k1] = input_img[:s0 - k0 - 1:-1, :]
-        output[k0:s0 + k0, -k1:] = input_img[:, :s1 - k1 - 1:-1]
+        output[..., k0:k0 + s0, :k1] = input_img[..., :s0, k1 - 1::-1]
+        output[..., :k0, k1:k1 + s1] = input_img[..., k0 - 1::-1, :s1]
+        output[..., -k0:, k1:s1 + k1] = input_img[..., :s0 - k0 - 1:-1, :]
+        output[..., k0:s0 + k0, -k1:] = input_img[..., :, :s1 - k1 - 1:-1]
     elif mode == "nearest":
     # 4 corners
-        output[s0 + k0:, s1 + k1:] = input_img[-1, -1]
-        output[:k0, :k1] = input_img[0, 0]
-        output[:k0, s1 + k1:] = input_img[0, -1]
-        output[s0 + k0:, :k1] = input_img[-1, 0]
+        output[..., s0 + k0:, s1 + k1:] = input_img[..., -1:, -1:]
+        output[..., :k0, :k1] = input_img[..., :1, :1]
+        output[..., :k0, s1 + k1:] = input_img[..., :1, -1:]
+        output[..., s0 + k0:, :k1] = input_img[..., -1:, :1]
     # 4 sides
-        output[k0:k0 + s0, :k1] = numpy.outer(input_img[:, 0], numpy.ones(k1))
-        output[:k0, k1:k1 + s1] = numpy.outer(numpy.ones(k0), input_img[0, :])
-        output[-k0:, k1:s1 + k1] = numpy.outer(numpy.ones(k0), input_img[-1, :])
-        output[k0:s0 + k0, -k1:] = numpy.outer(input_img[:, -1], numpy.ones(k1))
+        output[..., k0:k0 + s0, :k1] = input_img[..., :, :1]
+        output[..., :k0, k1:k1 + s1] = input_img[..., :1, :]
+        output[..., -k0:, k1:s1 + k1] = input_img[..., -1:, :]
+        output[..., k0:s0 + k0, -k1:] = input_img[..., :, -1:]
     elif mode == "wrap":
         # 4 corners
-        output[s0 + k0:, s1 + k1:] = input_img[:k0,:k1]
-        output[:k0, :k1] = input_img[-k0:,-k1:]
-        output[:k0, s1 + k1:] = input_img[-k0:,:k1]
-        output[s0 + k0:, :k1] = input_img[:k0,-k1:]
+        output[..., s0 + k0:, s1 + k1:] = input_img[..., :k0,:k1]
+        output[..., :k0, :k1] = input_img[..., -k0:,-k1:]
+        output[..., :k0, s1 + k1:] = input_img[..., -k0:,:k1]
+        output[..., s0 + k0:, :k1] = input_img[..., :k0,-k1:]
         # 4 sides
-        output[k0:k0 + s0, :k1] = input_img[:,-k1:]
-        output[:k0, k1:k1 + s1] = input_img[-k0:,:]
-        output[-k0:, k1:s1 + k1] = input_img[:k0,:]
-        output[k0:s0 + k0, -k1:] = input_img[:,:k1]
+        output[..., k0:k0 + s0, :k1] = input_img[..., :,-k1:]
+        output[..., :k0, k1:k1 + s1] = input_img[..., -k0:,:]
+        output[..., -k0:, k1:s1 + k1] = input_img[..., :k0,:]
+        output[..., k0:s0 + k0, -k1:] = input_img[..., :,:k1]
     elif mode != "constant": raise RuntimeError("Unknown mode")
         
     return output
     
     
+def downsample(input_img, factor):
+    """Average of the factor x factor blocks of the last two axes of input_img
+
+    Rows and columns which do not fill a complete block are dropped."""
+    if factor == 1:
+        return input_img
+    s0, s1 = input_img.shape[-2:]
+    d0, d1 = s0 // factor, s1 // factor
+    blocks = input_img[..., :d0 * factor, :d1 * factor].reshape(input_img.shape[:-2] + (d0, factor, d1, factor))
+    return blocks.mean(axis=-1).mean(axis=-2)
+
+
+def mirror_index(length, k):
+    """Index along one axis of the rows (or columns) of expand(img, k, mode="mirror"),
+    img having length rows: expand(img, k, "mirror")[p] is img[mirror_index(length, k)[p]]"""
+    index = numpy.abs(numpy.arange(-k, length + k))
+    return numpy.where(index >= length, 2 * (length - 1) - index, index)
+
+
+def tile_rows(height, halo, max_bytes, row_bytes):
+    """Split height rows into tiles for bounded memory processing
+
+    Yields (r0, r1, a0, a1): the tile covers rows r0:r1, which have to be
+    computed from rows a0:a1, the tile plus halo rows on each side (clipped to
+    the image, the filters then apply their own boundary mode, the same modes
+    as expand). Tiles are as high as fits in max_bytes, row_bytes being the
+    working memory of the processing per row, but at least 1 row.
+    """
+    rows = max(int(max_bytes // max(row_bytes, 1)) - 2 * halo, 1)
+    for r0 in range(0, height, rows):
+        r1 = min(r0 + rows, height)
+        yield r0, r1, max(r0 - halo, 0), min(r1 + halo, height)
+
+
+def apply_tiled(func, input_img, halo, max_bytes=None, output=None, bytes_per_pixel=8):
+    """output = func(input_img), computed tile by tile of rows (axis -2, see tile_rows)
+
+    func has to be a local operation of the last two axes whose support radius
+    is at most halo rows, then the result is the same as the whole image one.
+    bytes_per_pixel is the working memory of func per input pixel. Without
+    max_bytes, func is called once on the whole image.
+    """
+    if max_bytes is None:
+        if output is None:
+            return func(input_img)
+        output[...] = func(input_img)
+        return output
+    height = input_img.shape[-2]
+    row_bytes = bytes_per_pixel * input_img.size // max(height, 1)
+    for r0, r1, a0, a1 in tile_rows(height, halo, max_bytes, row_bytes):
+        tile = func(input_img[..., a0:a1, :])
+        if output is None:
+            output = numpy.empty(input_img.shape, dtype=tile.dtype)
+        output[..., r0:r1, :] = tile[..., r0 - a0:r1 - a0, :]
+    return output
+
+
+def next_fast_len(n):
+    """Smallest 2**a * 3**b * 5**c >= n, a fast FFT length"""
+    best = 2 * n
+    p5 = 1
+    while p5 < best:
+        p35 = p5
+        while p35 < best:
+            p = p35
+            while p < n:
+                p *= 2
+            best = min(best, p)
+            p35 *= 3
+        p5 *= 5
+    return best
+
+
 def calc_size(shape, bloc_size):
     '''
     returns the adapted size padded to the next multiple of bloc_size
@@ -80,15 +230,3 @@ def calc_size(shape, bloc_size):
         return tuple ((i + j - 1) & ~(j - 1) for i,j in zip(shape,bloc_size))    	
     else:
         return tuple ((i + bloc_size - 1) & ~(bloc_size - 1) for i in shape)
-    
-    
-
-    
-    
-    
-    
-    
-
-
-
-
@@ -0,0 +1,147 @@
+# coding utf8
+# Concurrent centring on a thread pool executor
+#
+# Needs concurrent.futures (the "futures" backport on Python 2). lucid is
+# Python 2 code, so there is no asyncio front-end.
+
+
+import threading
+from concurrent import futures
+import FFT
+import meshGen
+import centerId
+
+#Jobs accepted (waiting or running) per worker thread by default
+QUEUE_SIZE_PER_WORKER = 4
+
+
+class ServiceBusy(RuntimeError):
+    """The queue of a CentringService is full"""
+
+
+class CentringService(object):
+    """Run find_loop, find_loop_mesh and generate_meshing_info concurrently
+    on a pool of threads
+
+    Calls return concurrent.futures.Future objects. Each worker thread has its own FFT.LoopFinder
+    buffers, the rest of the detection code keeps no mutable state between
+    calls besides the FFT mask cache, which is locked. Most of the NumPy /
+    SciPy work releases the GIL, so frames processed at the same time
+    overlap on several cores.
+
+    At most max_pending jobs are accepted at once (running ones included),
+    submitting more raises ServiceBusy instead of queueing without bound.
+    Cancelling a job (Future.cancel or a timeout of result) removes it if it
+    did not start yet, a running detection goes to its end and its result
+    is dropped.
+
+    :param max_workers: Number of worker threads
+    :param max_pending: Jobs accepted at once, QUEUE_SIZE_PER_WORKER per worker by default
+    """
+    def __init__(self, max_workers=4, max_pending=None):
+        if max_pending is None:
+            max_pending = max_workers * QUEUE_SIZE_PER_WORKER
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._executor = futures.ThreadPoolExecutor(max_workers)
+        self._local = threading.local()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+    def shutdown(self, wait=True):
+        """Stop accepting jobs, and wait for the accepted ones if wait"""
+        self._executor.shutdown(wait)
+
+    def submit(self, function, *args, **kwargs):
+        """Run function(*args, **kwargs) on the pool, returns its Future
+
+        Raises ServiceBusy when max_pending jobs are already accepted."""
+        if not self._slots.acquire(False):
+            raise ServiceBusy("%d centring jobs already pending" % self.max_pending)
+        try:
+            future = self._executor.submit(self._run, function, args, kwargs)
+        except:
+            self._slots.release()
+            raise
+        future.add_done_callback(self._release_cancelled)
+        return future
+
+    def _run(self, function, args, kwargs):
+        # the slot is free before the result is set, a caller waiting for
+        # it can submit again at once
+        try:
+            return function(*args, **kwargs)
+        finally:
+            self._slots.release()
+
+    def _release_cancelled(self, future):
+        # cancelled before it ran, _run never released the slot
+        if future.cancelled():
+            self._slots.release()
+
+    def _find_loop(self, img, kwargs):
+        finder = getattr(self._local, "finder", None)
+        if finder is None:
+            finder = self._local.finder = FFT.LoopFinder()
+        return FFT.find_loop(img, workspace=finder, **kwargs)
+
+    def find_loop(self, img, **kwargs):
+        """Future of FFT.find_loop(img, **kwargs)"""
+        return self.submit(self._find_loop, img, kwargs)
+
+    def find_loop_mesh(self, imgInfo, **kwargs):
+        """Future of centerId.find_loop_mesh(imgInfo, **kwargs)"""
+        return self.submit(centerId.find_loop_mesh, imgInfo, **kwargs)
+
+    def generate_meshing_info(self, imgInfo, **kwargs):
+        """Future of meshGen.generate_meshing_info(imgInfo, **kwargs)"""
+        return self.submit(meshGen.generate_meshing_info, imgInfo, **kwargs)
+
+    def warm(self, img, **kwargs):
+        """Run find_loop(img, **kwargs) once on each worker thread, to fill
+        their LoopFinder buffers (and the FFT mask cache) for frames of this
+        size. Blocks until done.
+
+        The jobs wait for each other before running, so that no thread
+        takes two of them (only max_pending threads are warmed if it is the
+        smaller). Meant for an idle service: jobs already accepted delay the
+        warm-up, or make it raise ServiceBusy."""
+        count = min(self.max_workers, self.max_pending)
+        started = [0]
+        latch = threading.Condition()
+
+        def job():
+            with latch:
+                started[0] += 1
+                latch.notify_all()
+                while started[0] < count:
+                    latch.wait()
+            return self._find_loop(img, kwargs)
+
+        jobs = []
+        try:
+            for i in range(count):
+                jobs.append(self.submit(job))
+        except ServiceBusy:
+            # release the jobs already submitted
+            with latch:
+                started[0] = count
+                latch.notify_all()
+            raise
+        for future in jobs:
+            future.result()
+
+    @staticmethod
+    def result(future, timeout=None):
+        """Result of future, which is cancelled when it times out
+        (futures.TimeoutError raised after timeout seconds)"""
+        try:
+            return future.result(timeout)
+        except futures.TimeoutError:
+            future.cancel()
+            raise
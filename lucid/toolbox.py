@@ -7,12 +7,15 @@ __contact__ = "etienne.francois:esrf.fr"
 __copyright__ = "2013, ESRF"
 
 
-#import cv
-import scipy
+import scipy.ndimage
 import os
-import Image
 import numpy
 import math
+from myutils import lazy_import
+
+#Loaded on first use
+cv = lazy_import("cv")
+Image = lazy_import("Image")
 
 
 #================================================================================#
@@ -38,23 +41,76 @@ def toRadians(degrees):
 #================================================================================#
 
 
+#Wrap a raw frame buffer into a Numpy array, without copy
+def buffer2array(buf,shape,dtype=numpy.uint8):
+    """|
+
+    :param buf: Frame pixels, rows without padding
+    :type buf: Object exporting the buffer protocol (bytes, bytearray, memoryview, mmap...)
+    :param shape: Frame shape (height,width)
+    :type shape: Tuple (uint,uint)
+    :param dtype: Pixel type
+    :type dtype: Numpy dtype, uint8 or uint16 for most cameras
+
+    :returns: Numpy array sharing the memory of buf, read-only if buf is
+    """
+    dtype = numpy.dtype(dtype)
+    count = int(numpy.prod(shape))
+    try:
+        array = numpy.frombuffer(buf,dtype,count)
+    except (TypeError,AttributeError):
+        #memoryview on Python 2, through its PEP 3118 interface
+        array = numpy.asarray(buf).reshape(-1).view(numpy.uint8)[:count*dtype.itemsize].view(dtype)
+    return array.reshape(shape)
+
 #Convert disponible image information into an IplImage
-def imgInfo2cvImage(imgInfo):
+def imgInfo2cvImage(imgInfo,shape=None,bufferDtype=numpy.uint8):
     """|
 
     :param imgInfo: Image or part of image
-    :type imgInfo: String or Numpy array
+    :type imgInfo: String, Numpy array, or buffer when shape is given
+    :param shape: Frame shape of a buffer imgInfo, see buffer2array
+    :type shape: Tuple (uint,uint)
+    :param bufferDtype: Pixel type of a buffer imgInfo
+    :type bufferDtype: Numpy dtype
 
-    :returns: OpenCV IplImage 
+    :returns: OpenCV IplImage, sharing the memory of a writable array
     """
+    if shape is not None:
+        imgInfo = buffer2array(imgInfo,shape,bufferDtype)
     #Test what type of image data has been given as argument "imgInfo"
     if isinstance(imgInfo,numpy.ndarray):
+        if not imgInfo.flags.writeable:
+            #the OpenCV treatments work in place
+            imgInfo = imgInfo.copy()
         return cv.GetImage(cv.fromarray(imgInfo))
     elif isinstance(imgInfo,str):
         return cv.LoadImage(imgInfo,cv.CV_LOAD_IMAGE_GRAYSCALE)
     else:
         raise TypeError("Unsupported type : Image path (str) or numpyarray (numpy.ndarray) needed") 
 
+#Convert disponible image information into a Numpy array, without copy if possible
+def imgInfo2array(imgInfo,shape=None,bufferDtype=numpy.uint8):
+    """|
+
+    :param imgInfo: Image or part of image
+    :type imgInfo: String, Numpy array, or buffer when shape is given
+    :param shape: Frame shape of a buffer imgInfo, see buffer2array
+    :type shape: Tuple (uint,uint)
+    :param bufferDtype: Pixel type of a buffer imgInfo
+    :type bufferDtype: Numpy dtype
+
+    :returns: Numpy array, grayscale 8 bits when read from a file
+    """
+    if shape is not None:
+        return buffer2array(imgInfo,shape,bufferDtype)
+    if isinstance(imgInfo,numpy.ndarray):
+        return imgInfo
+    elif isinstance(imgInfo,str):
+        return numpy.asarray(Image.open(imgInfo).convert("L"))
+    else:
+        raise TypeError("Unsupported type : Image path (str) or numpyarray (numpy.ndarray) needed") 
+
 #Display fonction for cvImage
 def displayCv(*tupleDisplayable):
     """|
@@ -83,6 +139,47 @@ def white_detect(cvImg):
     """
     return (cv.Sum(cvImg))[0]/255
 
+#Summed-area table of a binary image for constant time white_detect on any window
+class IntegralImage(object):
+    """|
+
+    Precomputed integral image (summed-area table) of a binary (0/255) image.
+    Counting the white pixels of a window costs four lookups whatever its size.
+
+    :param image: Binary image
+    :type image: Numpy array
+    """
+    def __init__(self, image):
+        image = numpy.asarray(image)
+        self.height, self.width = image.shape
+        self.table = numpy.zeros((self.height + 1, self.width + 1), numpy.int32)
+        numpy.cumsum(image > 0, axis=0, dtype=numpy.int32, out=self.table[1:, 1:])
+        numpy.cumsum(self.table[1:, 1:], axis=1, out=self.table[1:, 1:])
+
+    def white_detect(self, y0, y1, x0, x1):
+        """|
+
+        :returns: The numbers of white pixels in image[y0:y1,x0:x1] (non negative bounds)
+        """
+        y0, y1 = min(y0, self.height), min(y1, self.height)
+        x0, x1 = min(x0, self.width), min(x1, self.width)
+        t = self.table
+        return int(t[y1, x1] - t[y0, x1] - t[y1, x0] + t[y0, x0])
+
+    def white_detect_many(self, y0, y1, x0, x1):
+        """|
+
+        Batch version of white_detect, bounds are arrays of the same shape.
+
+        :returns: Array of the numbers of white pixels in each window
+        """
+        y0 = numpy.clip(y0, 0, self.height)
+        y1 = numpy.clip(y1, 0, self.height)
+        x0 = numpy.clip(x0, 0, self.width)
+        x1 = numpy.clip(x1, 0, self.width)
+        t = self.table
+        return t[y1, x1] - t[y0, x1] - t[y1, x0] + t[y0, x0]
+
 #Morphological mathematic erosion function with num for how many times the file might be treated
 def erode(src,dest,num):
     """|
@@ -142,7 +239,7 @@ def smooth(src,dest,num):
 
 
 def threshold_adaptive(image, block_size, method='gaussian', offset=0,
-                       mode='reflect', param=None):
+                       mode='reflect', param=None, dtype='double'):
     """Applies an adaptive threshold to an array.
 
 Also known as local or dynamic thresholding where the threshold value is
@@ -180,6 +277,9 @@ Either specify sigma for 'gaussian' method or function object for
 'generic' method. This functions takes the flat array of local
 neighbourhood as a single argument and returns the calculated
 threshold for the centre pixel.
+dtype : numpy dtype, optional
+Floating point type the local thresholds are computed in, 'single'
+halves the memory of the filtering. Default is 'double'.
 
 Returns
 -------
@@ -198,7 +298,7 @@ Examples
 >>> func = lambda arr: arr.mean()
 >>> binary_image2 = threshold_adaptive(image, 15, 'generic', param=func)
 """
-    thresh_image = numpy.zeros(image.shape, 'double')
+    thresh_image = numpy.zeros(image.shape, dtype)
     if method == 'generic':
         scipy.ndimage.generic_filter(image, param, block_size,
             output=thresh_image, mode=mode)
@@ -223,16 +323,31 @@ Examples
 
     return image > (thresh_image - offset)
 
+def uint8_histogram(image):
+    """Exact 256 bins histogram of an uint8 array, by blocks to avoid a full size copy"""
+    image = image.ravel()
+    counts = numpy.zeros(256, numpy.intp)
+    for i in range(0, image.size, 65536):
+        counts += numpy.bincount(image[i:i + 65536], minlength=256)
+    return counts
+
 def get_background_threshold(image, mask = None):
     """Get threshold based on the mode of the image
     The threshold is calculated by calculating the mode and multiplying by
     2 (an arbitrary empirical factor). The user will presumably adjust the
     multiplication factor as needed."""
-    cropped_image = numpy.array(image.flat) if mask is None else image[mask]
+    cropped_image = numpy.ravel(image) if mask is None else image[mask]
     if numpy.product(cropped_image.shape)==0:
         return 0
-    img_min = numpy.min(cropped_image)
-    img_max = numpy.max(cropped_image)
+    if cropped_image.dtype == numpy.uint8:
+        # work on the histogram of the 256 possible values
+        counts = uint8_histogram(cropped_image)
+        values = numpy.flatnonzero(counts)
+        img_min = cropped_image.dtype.type(values[0])
+        img_max = cropped_image.dtype.type(values[-1])
+    else:
+        img_min = numpy.min(cropped_image)
+        img_max = numpy.max(cropped_image)
     if img_min == img_max:
         return cropped_image[0]
     
@@ -240,12 +355,20 @@ def get_background_threshold(image, mask = None):
     robust_min = 0.02 * (img_max - img_min) + img_min
     robust_max = 0.98 * (img_max - img_min) + img_min
     nbins = 256
-    cropped_image = cropped_image[numpy.logical_and(cropped_image > robust_min,
-                                                 cropped_image < robust_max)]
-    if len(cropped_image) == 0:
-        return robust_min
+    if cropped_image.dtype == numpy.uint8:
+        values = values[numpy.logical_and(values > robust_min, values < robust_max)]
+        if len(values) == 0:
+            return robust_min
+        # same bins as scipy.ndimage.histogram, weighted by the pixel counts
+        bins = numpy.linspace(robust_min, robust_max, nbins + 1)
+        h = numpy.histogram(values, bins, weights=counts[values])[0]
+    else:
+        cropped_image = cropped_image[numpy.logical_and(cropped_image > robust_min,
+                                                     cropped_image < robust_max)]
+        if len(cropped_image) == 0:
+            return robust_min
     
-    h = scipy.ndimage.histogram(cropped_image, robust_min, robust_max, nbins)
+        h = scipy.ndimage.histogram(cropped_image, robust_min, robust_max, nbins)
     index = numpy.argmax(h)
     cutoff = float(index) / float(nbins-1)
     #
@@ -262,17 +385,44 @@ def get_robust_background_threshold(image, mask = None):
        The threshold is calculated by trimming the top and bottom 5% of
        pixels off the image, then calculating the mean and standard deviation
        of the remaining image. The threshold is then set at 2 (empirical
-       value) standard deviations above the mean.""" 
-
-    cropped_image = numpy.array(image.flat) if mask is None else image[mask]
-    if numpy.product(cropped_image.shape)<3:
+       value) standard deviations above the mean.
+       
+       uint8 images are handled through their histogram, other types with a
+       partial sort (selection) of the trimmed values.""" 
+
+    cropped_image = numpy.ravel(image) if mask is None else image[mask]
+    n = numpy.product(cropped_image.shape)
+    if n<3:
         return 0
+    chop = int(round(n * .05))
+
+    if cropped_image.dtype == numpy.uint8:
+        counts = uint8_histogram(cropped_image)
+        values = numpy.flatnonzero(counts)
+        if len(values) == 1:
+            return cropped_image[0]
+        # number of pixels of each value within the ranks [chop, n-chop)
+        high = numpy.cumsum(counts)
+        low = high - counts
+        end = n - chop if chop else 0
+        kept = numpy.clip(high, chop, end) - numpy.clip(low, chop, end)
+        kept = kept[values]
+        size = int(kept.sum())
+        if size == 0:
+            return float('nan')
+        # exact integer sums
+        s1 = int(numpy.dot(kept, values))
+        s2 = int(numpy.dot(kept, values * values))
+        mean = float(s1) / size
+        sd = math.sqrt(float(size * s2 - s1 * s1) / (size * size))
+        return mean+sd*2
+
     if numpy.min(cropped_image) == numpy.max(cropped_image):
         return cropped_image[0]
-    
-    cropped_image.sort()
-    chop = int(round(numpy.product(cropped_image.shape) * .05))
-    im   = cropped_image[chop:-chop]
+    if chop:
+        im = numpy.partition(cropped_image, (chop, n - chop - 1))[chop:n - chop]
+    else:
+        im = cropped_image[0:0]
     mean = im.mean()
     sd   = im.std()
     return mean+sd*2
@@ -287,3 +437,62 @@ def hist_eq(im,nbr_bins=256):
    im2 = numpy.interp(im.flatten(),bins[:-1],cdf)
 
    return im2.reshape(im.shape), cdf
+
+def bbox(binimg):
+    """Bounding box (min0, max0, min1, max1) of the non zero pixels, maxima excluded
+
+    Same as mahotas.bbox: all zeros for an empty image."""
+    rows = numpy.flatnonzero(binimg.any(axis=1))
+    if rows.size == 0:
+        return 0, 0, 0, 0
+    cols = numpy.flatnonzero(binimg.any(axis=0))
+    return rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+
+def row_extremes(binimg):
+    """(x, y) coordinates of the first and last non zero pixel of each row
+
+    These boundary pixels have the same convex hull as the whole image."""
+    mask = numpy.asarray(binimg, bool)
+    ys = numpy.flatnonzero(mask.any(axis=1))
+    rows = mask[ys]
+    first = rows.argmax(axis=1)
+    last = mask.shape[1] - 1 - rows[:, ::-1].argmax(axis=1)
+    return numpy.concatenate((numpy.column_stack((first, ys)), numpy.column_stack((last, ys))))
+
+def convex_hull(points):
+    """Convex hull of (x, y) points by Andrew's monotone chain
+
+    :returns: (N, 2) array of the hull vertices, counter clockwise in (x, y)
+              axes, without collinear points (a single point or a segment
+              for degenerate inputs)
+    """
+    points = sorted(set(map(tuple, numpy.asarray(points).tolist())))
+    if len(points) < 3:
+        return numpy.array(points, float).reshape(-1, 2)
+
+    def cross(o, a, b):
+        return (a[0] - o[0]) * (b[1] - o[1]) - (a[1] - o[1]) * (b[0] - o[0])
+
+    lower = []
+    for p in points:
+        while len(lower) >= 2 and cross(lower[-2], lower[-1], p) <= 0:
+            lower.pop()
+        lower.append(p)
+    upper = []
+    for p in reversed(points):
+        while len(upper) >= 2 and cross(upper[-2], upper[-1], p) <= 0:
+            upper.pop()
+        upper.append(p)
+    return numpy.array(lower[:-1] + upper[:-1], float)
+
+def polygon_centroid(vertices):
+    """Centroid (x, y) of a polygon by the shoelace formula
+
+    Degenerate polygons (a point or a segment) give the mean of their vertices."""
+    x, y = numpy.asarray(vertices, float).T
+    x1, y1 = numpy.roll(x, -1), numpy.roll(y, -1)
+    cross = x * y1 - x1 * y
+    area = cross.sum() / 2.0
+    if area == 0:
+        return x.mean(), y.mean()
+    return ((x + x1) * cross).sum() / (6 * area), ((y + y1) * cross).sum() / (6 * area)
@@ -0,0 +1,97 @@
+# coding utf8
+# Loop tracking on live camera feeds
+
+
+import numpy
+import FFT
+
+#Largest change of the 4x4 pixels block averages (grey levels) under which a
+#frame is considered unchanged, averaging takes the camera noise down
+FRAME_DIFF_THRESHOLD = 10.0
+#Half size in pixels of the search window around the last position
+ROI_HALF_SIZE = int(FFT.LOOP_MAX_WIDTH*FFT.PIXELS_PER_MM_HOR)
+
+
+class LoopTracker(object):
+    """Stateful loop detection on a sequence of frames
+
+    The first frame, and any frame where tracking is lost, goes through a
+    full frame detection. Afterwards, only a window around the last position
+    is processed, and frames which did not change (no 4x4 block average moved
+    by diff_threshold or more since the last processed frame, in that window)
+    are not processed at all.
+
+    One tracker follows one camera feed, it is not meant to be shared
+    between threads.
+
+    :param detector: Detection function, called as detector(img) and returning (label, x, y), FFT.find_loop by default
+    :param diff_threshold: Largest change of the 4x4 block averages (grey levels) under which the last result is reused
+    :param roi_half_size: Half size in pixels of the search window around the last position
+    :param edge_margin: Tracking is lost when the loop is found closer than this to the window edge
+
+    Attributes after each update: result, roi (x0, y0, x1, y1) or None, and
+    status, one of "full" (full frame detection), "roi" (window detection),
+    "static" (frame unchanged, result reused) or "lost" (no loop found).
+    """
+    def __init__(self, detector=None, diff_threshold=FRAME_DIFF_THRESHOLD,
+                 roi_half_size=ROI_HALF_SIZE, edge_margin=10):
+        self.detector = detector if detector is not None else FFT.find_loop
+        self.diff_threshold = diff_threshold
+        self.roi_half_size = roi_half_size
+        self.edge_margin = edge_margin
+        self.reset()
+
+    def reset(self):
+        """Forget the tracking state, next frame gets a full frame detection"""
+        self.result = ("No loop detected", -1, -1)
+        self.roi = None
+        self.status = "lost"
+        self._reference = None
+
+    def update(self, frame):
+        """Process one frame (2D numpy array) and return (label, x, y) in frame pixels"""
+        frame = numpy.asarray(frame)
+        if self.roi is not None and frame.shape == self._reference.shape:
+            x0, y0, x1, y1 = self.roi
+            if self._difference(frame[y0:y1, x0:x1], self._reference[y0:y1, x0:x1]) < self.diff_threshold:
+                self.status = "static"
+                return self.result
+            label, x, y = self.detector(frame[y0:y1, x0:x1])
+            if label != "No loop detected" and self._inside(x, y, x1 - x0, y1 - y0):
+                self._found(frame, (label, x + x0, y + y0), "roi")
+                return self.result
+
+        label, x, y = self.detector(frame)
+        if label == "No loop detected":
+            self.reset()
+            return self.result
+        self._found(frame, (label, x, y), "full")
+        return self.result
+
+    def track(self, frames):
+        """Generator of the results of update foreach frame of an iterable"""
+        for frame in frames:
+            yield self.update(frame)
+
+    def _found(self, frame, result, status):
+        label, x, y = result
+        height, width = frame.shape[:2]
+        half = self.roi_half_size
+        self.roi = (max(x - half, 0), max(y - half, 0), min(x + half, width), min(y + half, height))
+        self.result = result
+        self.status = status
+        # the camera may reuse its buffer
+        self._reference = frame.copy()
+
+    def _inside(self, x, y, width, height):
+        m = self.edge_margin
+        return m <= x < width - m and m <= y < height - m
+
+    @staticmethod
+    def _difference(a, b):
+        height, width = a.shape[0] // 4 * 4, a.shape[1] // 4 * 4
+        if height == 0 or width == 0:
+            return 0.0
+        diff = a[:height, :width].astype(numpy.float32) - b[:height, :width]
+        blocks = diff.reshape(height // 4, 4, width // 4, 4).mean(axis=3).mean(axis=1)
+        return numpy.abs(blocks).max()
@@ -1,9 +1,16 @@
-from distutils.core import setup
 import sys
+try:
+    from setuptools import setup
+    # concurrent.futures backport, the standard library has it on Python 3
+    dependencies = {"install_requires": ['futures; python_version < "3"']}
+except ImportError:
+    from distutils.core import setup
+    dependencies = {"requires": ["futures"] if sys.version_info[0] < 3 else []}
 
 setup(name = "lucid",version = "0.1",
       description = "Loop and uCrystals Identification", 
       author="E. Francois, J. Kieffer, M. Guijarro (ESRF)",
       package_dir={"lucid": "lucid"},
-      packages = ["lucid"])
+      packages = ["lucid"],
+      **dependencies)
 
@@ -0,0 +1,52 @@
+# coding utf8
+# find_loop_batch against find_loop frame by frame
+
+
+import unittest
+
+import numpy
+
+from lucid import FFT
+from benchmarks import synthetic
+
+#Frames of the stack, fixed seed
+FRAMES = 30
+SEED = 0
+
+
+class BatchTest(unittest.TestCase):
+    """find_loop_batch gives the find_loop result of each frame"""
+
+    def check(self, pixel_type, **kwargs):
+        scenes = synthetic.scenes(FRAMES, seed=SEED)
+        stack = numpy.array([scene.render(SEED + i, pixel_type) for i, scene in enumerate(scenes)])
+        ppm = scenes[0].pixels_per_mm
+        batch = FFT.find_loop_batch(stack, ppm, **kwargs)
+        for i, frame in enumerate(stack):
+            self.assertEqual(batch[i], FFT.find_loop(frame, pixels_per_mm_horizontal=ppm, **kwargs),
+                             "frame %d" % i)
+
+    def test_uint8(self):
+        self.check(numpy.uint8)
+
+    def test_float32(self):
+        self.check(numpy.float32)
+
+    def test_uint8_single_precision(self):
+        self.check(numpy.uint8, dtype=numpy.float32)
+
+    def test_tiled(self):
+        self.check(numpy.uint8, max_bytes=2**20)
+
+    def test_roi(self):
+        self.check(numpy.uint8, roi=(100, 50, 600, 400))
+        scene = synthetic.scenes(1, seed=SEED)[0]
+        label, x, y = FFT.find_loop(scene.render(SEED), pixels_per_mm_horizontal=scene.pixels_per_mm,
+                                    roi=(100, 50, 600, 400))
+        self.assertEqual(label, "Coord")
+        # same coordinate types as the full frame path
+        self.assertEqual((type(x), type(y)), (int, int))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,50 @@
+# coding utf8
+# find_loop in single precision against double precision
+
+
+import unittest
+
+import numpy
+
+from lucid import FFT
+from benchmarks import synthetic
+
+#Scenes of the comparison, fixed seed
+FRAMES = 12
+SEED = 0
+
+
+class SinglePrecisionTest(unittest.TestCase):
+    """float32 processing keeps the loop centre within a pixel of float64"""
+
+    def check(self, sensor, zoom=1.0, **kwargs):
+        for i, scene in enumerate(synthetic.scenes(FRAMES, sensor, zoom, SEED)):
+            img = scene.render(SEED + i)
+            ppm = scene.pixels_per_mm
+            single = FFT.find_loop(img, pixels_per_mm_horizontal=ppm, dtype=numpy.float32, **kwargs)
+            double = FFT.find_loop(img, pixels_per_mm_horizontal=ppm, dtype=numpy.float64, **kwargs)
+            self.assertEqual(single[0], double[0], "frame %d: %s / %s" % (i, single, double))
+            self.assertLessEqual(abs(single[1] - double[1]), 1, "frame %d: %s / %s" % (i, single, double))
+            self.assertLessEqual(abs(single[2] - double[2]), 1, "frame %d: %s / %s" % (i, single, double))
+
+    def test_centres(self):
+        self.check("659x463")
+
+    def test_centres_zoom(self):
+        self.check("659x463", zoom=2.0)
+
+    def test_centres_tiled(self):
+        self.check("659x463", max_bytes=2**20)
+
+    def test_loop_finder(self):
+        scene = synthetic.scenes(1, seed=SEED)[0]
+        img = scene.render(SEED)
+        finder = FFT.LoopFinder(scene.pixels_per_mm, dtype=numpy.float32)
+        single = finder(img)
+        double = FFT.find_loop(img, pixels_per_mm_horizontal=scene.pixels_per_mm)
+        self.assertEqual(single[0], double[0])
+        self.assertLessEqual(max(abs(single[1] - double[1]), abs(single[2] - double[2])), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+# coding utf8
+# find_loop by bands of rows against whole images
+
+
+import unittest
+
+import numpy
+
+from lucid import FFT
+from benchmarks import synthetic
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+#Scenes of the comparison, fixed seed
+FRAMES = 6
+SEED = 0
+#Small enough for tens of bands per frame
+MAX_BYTES = 2**20
+
+
+class TiledTest(unittest.TestCase):
+    """The tiled mode gives the whole image results"""
+
+    def scenes(self, sensor="659x463"):
+        for i, scene in enumerate(synthetic.scenes(FRAMES, sensor, seed=SEED)):
+            yield scene, scene.render(SEED + i)
+
+    def test_gradient(self):
+        for scene, img in self.scenes():
+            whole = FFT.gradient_magnitude(FFT.subtract_background(FFT.gaussian_smooth(img, dtype=numpy.float64)))
+            tiled = FFT.tiled_gradient(img, MAX_BYTES)
+            self.assertEqual(tiled.shape, whole.shape)
+            self.assertEqual(tiled.dtype, numpy.uint8)
+            # rounding of the transforms only
+            self.assertLessEqual(numpy.abs(tiled.astype(int) - whole).max(), 1)
+
+    def test_centres(self):
+        for sensor in ("659x463", "1360x1024"):
+            for scene, img in self.scenes(sensor):
+                ppm = scene.pixels_per_mm
+                whole = FFT.find_loop(img, pixels_per_mm_horizontal=ppm)
+                tiled = FFT.find_loop(img, pixels_per_mm_horizontal=ppm, max_bytes=MAX_BYTES)
+                self.assertEqual(tiled[0], whole[0])
+                self.assertLessEqual(max(abs(tiled[1] - whole[1]), abs(tiled[2] - whole[2])), 1,
+                                     "%s / %s" % (tiled, whole))
+
+    def test_opening(self):
+        scene, img = next(self.scenes())
+        mag = FFT.tiled_gradient(img, MAX_BYTES)
+        whole = FFT.threshold_opening(mag, 30)
+        tiled = FFT.threshold_opening(mag, 30, max_bytes=2**14)
+        self.assertTrue(numpy.array_equal(tiled, whole))
+
+    @unittest.skipIf(tracemalloc is None, "tracemalloc needed")
+    def test_peak_memory(self):
+        scene = synthetic.scenes(1, "1360x1024", seed=SEED)[0]
+        img = scene.render(SEED)
+        peaks = []
+        for max_bytes in (None, MAX_BYTES):
+            tracemalloc.start()
+            try:
+                FFT.find_loop(img, pixels_per_mm_horizontal=scene.pixels_per_mm, max_bytes=max_bytes)
+                peaks.append(tracemalloc.get_traced_memory()[1])
+            finally:
+                tracemalloc.stop()
+        # uint8 gradient, boolean openings and their temporaries
+        self.assertLess(peaks[1], 6 * img.size + 2 * MAX_BYTES)
+        self.assertLess(peaks[1], peaks[0] / 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,29 @@
+# coding utf8
+# LoopFinder buffers
+
+
+import unittest
+
+from lucid import FFT
+from benchmarks import synthetic
+
+SEED = 0
+
+
+class WorkspaceTest(unittest.TestCase):
+    """A LoopFinder gives the find_loop results and keeps a bounded set of buffers"""
+
+    def test_windows(self):
+        scene = synthetic.scenes(1, seed=SEED)[0]
+        img = scene.render(SEED)
+        finder = FFT.LoopFinder(scene.pixels_per_mm)
+        # windows of a different size on each call, as with roi "auto"
+        for margin in range(0, 40, 4):
+            roi = (100 - margin, 50, 600 + margin, 400)
+            self.assertEqual(finder(img, roi=roi),
+                             FFT.find_loop(img, pixels_per_mm_horizontal=scene.pixels_per_mm, roi=roi))
+            self.assertLessEqual(len(finder._buffers), FFT.WORKSPACE_SHAPES)
+
+
+if __name__ == "__main__":
+    unittest.main()